@@ -1,10 +1,17 @@
 import asyncio
+import base64
 import hashlib
+import hmac
+import json
 import logging
 import os
+import sqlite3
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from enum import Enum
 from logging import Logger
+from typing import Optional, Dict, Callable, Awaitable, Any, Tuple, Generator, List
 from urllib.parse import urlparse, ParseResult
 
 import aiohttp
@@ -12,6 +19,18 @@ from aiohttp import ClientError
 from starlette.requests import Request
 
 logger: Logger = logging.getLogger(__name__)
+HTTP_CLIENT_CONNECTION_LIMIT: int = int(os.getenv("HTTP_CLIENT_CONNECTION_LIMIT") or 100)
+HTTP_CLIENT_CONNECTION_LIMIT_PER_HOST: int = int(os.getenv("HTTP_CLIENT_CONNECTION_LIMIT_PER_HOST") or 20)
+HTTP_CLIENT_DNS_CACHE_TTL: int = int(os.getenv("HTTP_CLIENT_DNS_CACHE_TTL") or 300)
+HTTP_CLIENT_KEEP_ALIVE_TIMEOUT: float = float(os.getenv("HTTP_CLIENT_KEEP_ALIVE_TIMEOUT") or 30)
+HTTP_CLIENT_CONNECT_TIMEOUT: float = float(os.getenv("HTTP_CLIENT_CONNECT_TIMEOUT") or 10)
+HTTP_CLIENT_READ_TIMEOUT: float = float(os.getenv("HTTP_CLIENT_READ_TIMEOUT") or 300)
+HTTP_CLIENT_MAX_RETRIES: int = int(os.getenv("HTTP_CLIENT_MAX_RETRIES") or 3)
+HTTP_CLIENT_RETRYABLE_STATUS_CODES: List[int] = [429, 500, 502, 503, 504]
+JWT_CACHE_TTL: float = float(os.getenv("JWT_CACHE_TTL") or 300)
+JWT_NEGATIVE_CACHE_TTL: float = float(os.getenv("JWT_NEGATIVE_CACHE_TTL") or 10)
+JWT_CACHE_MAX_SIZE: int = int(os.getenv("JWT_CACHE_MAX_SIZE") or 10000)
+JWT_SECRET: Optional[str] = os.getenv("OPEN_WEBUI_JWT_SECRET")
 
 
 class Constants(Enum):
@@ -36,13 +55,162 @@ def get_sha256_hash(text: str) -> str:
     return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
 
-async def is_valid_jwt_token(jwt_token: str) -> bool:
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(f"{Constants.OPEN_WEBUI_URL.value}/api/models", headers={'Authorization': f'Bearer {jwt_token}'}) as response:
-                return response.status == 200
-        except ClientError:
+@contextmanager
+def get_database_connection() -> Generator[sqlite3.Connection, None, None]:
+    connection: sqlite3.Connection = sqlite3.connect(os.getenv("INTELLIGENCE_SERVICE_DATABASE_PATH") or f"{Constants.DATA_PATH.value}intelligence.db")
+    connection.row_factory = sqlite3.Row
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+class HTTPClient:
+    _session: Optional[aiohttp.ClientSession] = None
+    _statistics: Dict[str, int] = {
+        "request_count": 0,
+        "connection_created_count": 0,
+        "connection_reused_count": 0,
+        "dns_cache_hit_count": 0,
+        "dns_cache_miss_count": 0,
+    }
+
+    @staticmethod
+    def _get_counter(key: str) -> Callable[..., Awaitable[None]]:
+        async def count(*_: Any) -> None:
+            HTTPClient._statistics[key] += 1
+
+        return count
+
+    @staticmethod
+    def get_session() -> aiohttp.ClientSession:
+        if HTTPClient._session is None or HTTPClient._session.closed:
+            trace_config: aiohttp.TraceConfig = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(HTTPClient._get_counter("request_count"))
+            trace_config.on_connection_create_end.append(HTTPClient._get_counter("connection_created_count"))
+            trace_config.on_connection_reuseconn.append(HTTPClient._get_counter("connection_reused_count"))
+            trace_config.on_dns_cache_hit.append(HTTPClient._get_counter("dns_cache_hit_count"))
+            trace_config.on_dns_cache_miss.append(HTTPClient._get_counter("dns_cache_miss_count"))
+
+            HTTPClient._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=HTTP_CLIENT_CONNECTION_LIMIT,
+                    limit_per_host=HTTP_CLIENT_CONNECTION_LIMIT_PER_HOST,
+                    ttl_dns_cache=HTTP_CLIENT_DNS_CACHE_TTL,
+                    keepalive_timeout=HTTP_CLIENT_KEEP_ALIVE_TIMEOUT,
+                ),
+                timeout=aiohttp.ClientTimeout(total=None, connect=HTTP_CLIENT_CONNECT_TIMEOUT, sock_read=HTTP_CLIENT_READ_TIMEOUT),
+                trace_configs=[trace_config],
+            )
+
+        return HTTPClient._session
+
+    @staticmethod
+    async def request_json(method: str, url: str, headers: Optional[Dict[str, Any]] = None, json_data: Any = None) -> Any:
+        #   Rate limits and transient server errors are retried after the delay the server asks for, or an exponential backoff
+        for attempt in range(HTTP_CLIENT_MAX_RETRIES + 1):
+            async with HTTPClient.get_session().request(method, url, headers=headers, json=json_data) as response:
+                if response.status in HTTP_CLIENT_RETRYABLE_STATUS_CODES and attempt < HTTP_CLIENT_MAX_RETRIES:
+                    retry_after: Optional[str] = response.headers.get("Retry-After")
+                    delay: float = float(retry_after) if retry_after is not None and retry_after.isdigit() else 2 ** attempt
+                    logger.warning(f"Retrying the request in {delay} seconds | {response.status} | {method} {url}")
+                    await asyncio.sleep(delay)
+                    continue
+
+                response.raise_for_status()
+                return await response.json()
+
+        raise RuntimeError(f"Unreachable retry state for {method} {url}")
+
+    @staticmethod
+    def get_statistics() -> Dict[str, int]:
+        return dict(HTTPClient._statistics)
+
+    @staticmethod
+    async def close() -> None:
+        if HTTPClient._session is not None and not HTTPClient._session.closed:
+            await HTTPClient._session.close()
+        HTTPClient._session = None
+
+
+_jwt_validation_cache: OrderedDict[str, Tuple[bool, float]] = OrderedDict()
+_jwt_validation_task_dict: Dict[str, asyncio.Task] = {}
+
+
+def _decode_jwt_segment(segment: str) -> Any:
+    return json.loads(base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4)))
+
+
+def _get_jwt_payload(jwt_token: str) -> Any:
+    try:
+        return _decode_jwt_segment(jwt_token.split(".")[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _is_valid_jwt_payload(payload: Any) -> bool:
+    if not isinstance(payload, dict):
+        return False
+
+    expiry: Any = payload.get("exp")
+    return expiry is None or (isinstance(expiry, (int, float)) and not isinstance(expiry, bool) and expiry > time.time())
+
+
+def _is_valid_jwt_signature(jwt_token: str, secret: str) -> bool:
+    try:
+        header_segment, payload_segment, signature_segment = jwt_token.split(".")
+        header: Any = _decode_jwt_segment(header_segment)
+        if not isinstance(header, dict) or header.get("alg") != "HS256":
             return False
+    except ValueError:
+        return False
+
+    signature: bytes = hmac.new(secret.encode("utf-8"), f"{header_segment}.{payload_segment}".encode("utf-8"), hashlib.sha256).digest()
+    return hmac.compare_digest(base64.urlsafe_b64encode(signature).rstrip(b"=").decode("utf-8"), signature_segment)
+
+
+async def _request_jwt_token_validation(jwt_token: str, cache_key: str, expiry: Optional[float]) -> bool:
+    try:
+        async with HTTPClient.get_session().get(f"{Constants.OPEN_WEBUI_URL.value}/api/models", headers={'Authorization': f'Bearer {jwt_token}'}) as response:
+            is_valid: bool = response.status == 200
+    except (ClientError, asyncio.TimeoutError):
+        return False
+
+    expires_at: float = time.time() + (JWT_CACHE_TTL if is_valid else JWT_NEGATIVE_CACHE_TTL)
+    _jwt_validation_cache[cache_key] = (is_valid, expires_at if expiry is None else min(expires_at, expiry))
+    _jwt_validation_cache.move_to_end(cache_key)
+    while len(_jwt_validation_cache) > JWT_CACHE_MAX_SIZE:
+        _jwt_validation_cache.popitem(last=False)
+
+    return is_valid
+
+
+async def is_valid_jwt_token(jwt_token: str) -> bool:
+    #   Tokens that do not decode as a JWT, such as API keys, are left to Open WebUI, malformed or expired JWTs are rejected
+    payload: Any = _get_jwt_payload(jwt_token)
+    if payload is not None and not _is_valid_jwt_payload(payload):
+        return False
+
+    expiry: Optional[float] = payload.get("exp") if payload is not None else None
+
+    if JWT_SECRET is not None and payload is not None:
+        return _is_valid_jwt_signature(jwt_token, JWT_SECRET)
+
+    cache_key: str = hashlib.sha256(jwt_token.encode("utf-8")).hexdigest()
+    cached_result: Optional[Tuple[bool, float]] = _jwt_validation_cache.get(cache_key)
+    if cached_result is not None and cached_result[1] > time.time():
+        _jwt_validation_cache.move_to_end(cache_key)
+        return cached_result[0]
+
+    #   Concurrent validations of the same token share a single request to Open WebUI
+    task: Optional[asyncio.Task] = _jwt_validation_task_dict.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(_request_jwt_token_validation(jwt_token, cache_key, expiry))
+        _jwt_validation_task_dict[cache_key] = task
+        task.add_done_callback(lambda _: _jwt_validation_task_dict.pop(cache_key, None))
+
+    return await asyncio.shield(task)
 
 
 async def wait_for_connection(url: str, timeout: int = 60) -> None:
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from enum import Enum
+from logging import Logger
+from typing import Optional, Dict, List, Callable, Awaitable
+
+from pydantic import BaseModel, Field
+
+import common
+from models import UpsertStatistics
+
+logger: Logger = logging.getLogger(__name__)
+JOB_CONCURRENCY: int = int(os.getenv("INTELLIGENCE_SERVICE_JOB_CONCURRENCY") or 2)
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Job(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    status: JobStatus = JobStatus.QUEUED
+    statistics: UpsertStatistics = Field(default_factory=UpsertStatistics)
+    error: Optional[str] = None
+    created_at: float = Field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    def _save(self) -> None:
+        with common.get_database_connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO job (id, name, status, statistics, error, created_at, started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.id, self.name, self.status.value, self.statistics.model_dump_json(), self.error, self.created_at, self.started_at, self.finished_at)
+            )
+
+    async def save(self) -> None:
+        await asyncio.to_thread(self._save)
+
+    @staticmethod
+    def _get(job_id: str) -> Optional["Job"]:
+        with common.get_database_connection() as connection:
+            row: Optional[sqlite3.Row] = connection.execute("SELECT * FROM job WHERE id = ?", (job_id,)).fetchone()
+
+        if row is None:
+            return None
+
+        return Job(
+            id=row["id"],
+            name=row["name"],
+            status=JobStatus(row["status"]),
+            statistics=UpsertStatistics.model_validate_json(row["statistics"]),
+            error=row["error"],
+            created_at=row["created_at"],
+            started_at=row["started_at"],
+            finished_at=row["finished_at"],
+        )
+
+
+class JobQueue:
+    _queue: Optional[asyncio.Queue[Optional[str]]] = None
+    _worker_list: List[asyncio.Task] = []
+    _job_dict: Dict[str, Job] = {}
+    _job_func_dict: Dict[str, Callable[[UpsertStatistics], Awaitable[UpsertStatistics]]] = {}
+
+    @staticmethod
+    def _initialize_database() -> None:
+        with common.get_database_connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS job (id TEXT PRIMARY KEY, name TEXT NOT NULL, status TEXT NOT NULL, statistics TEXT NOT NULL, error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL)")
+            #   Jobs that were still pending when the service stopped will never complete
+            connection.execute("UPDATE job SET status = ?, error = ?, finished_at = ? WHERE status IN (?, ?)",
+                               (JobStatus.FAILED.value, "Interrupted by a restart of the service", time.time(), JobStatus.QUEUED.value, JobStatus.RUNNING.value))
+
+    @staticmethod
+    async def _work(queue: asyncio.Queue[Optional[str]]) -> None:
+        while (job_id := await queue.get()) is not None:
+            job: Job = JobQueue._job_dict[job_id]
+            job_func: Callable[[UpsertStatistics], Awaitable[UpsertStatistics]] = JobQueue._job_func_dict.pop(job_id)
+
+            job.status = JobStatus.RUNNING
+            job.started_at = time.time()
+            await job.save()
+            logger.info(f"Job started: {job.name} | {job.id}")
+
+            try:
+                job.statistics = await job_func(job.statistics)
+                job.status = JobStatus.DONE
+                logger.info(f"Job completed: {job.name} | {job.id} | {job.statistics}")
+            except Exception as e:
+                job.status = JobStatus.FAILED
+                job.error = str(e)
+                logger.error(f"Job failed: {job.name} | {job.id} | {str(e)}")
+
+            job.finished_at = time.time()
+            await job.save()
+            JobQueue._job_dict.pop(job_id, None)
+
+    @staticmethod
+    async def start(concurrency: int = JOB_CONCURRENCY) -> None:
+        await asyncio.to_thread(JobQueue._initialize_database)
+        queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+        JobQueue._queue = queue
+        JobQueue._worker_list = [asyncio.create_task(JobQueue._work(queue)) for _ in range(concurrency)]
+
+    @staticmethod
+    async def stop() -> None:
+        for worker in JobQueue._worker_list:
+            worker.cancel()
+        await asyncio.gather(*JobQueue._worker_list, return_exceptions=True)
+        JobQueue._worker_list = []
+        JobQueue._queue = None
+
+    @staticmethod
+    async def enqueue(name: str, job_func: Callable[[UpsertStatistics], Awaitable[UpsertStatistics]]) -> Job:
+        if JobQueue._queue is None:
+            raise RuntimeError("The job queue has not been started")
+
+        #   A job that is already waiting or running for the same target is not queued a second time
+        active_job: Optional[Job] = next(filter(lambda j: j.name == name, JobQueue._job_dict.values()), None)
+        if active_job is not None:
+            logger.debug(f"Job already active: {name} | {active_job.id}")
+            return active_job
+
+        job: Job = Job(name=name)
+        JobQueue._job_dict[job.id] = job
+        JobQueue._job_func_dict[job.id] = job_func
+        await job.save()
+        await JobQueue._queue.put(job.id)
+        logger.debug(f"Job queued: {name} | {job.id}")
+
+        return job
+
+    @staticmethod
+    async def get(job_id: str) -> Optional[Job]:
+        if job_id in JobQueue._job_dict:
+            return JobQueue._job_dict[job_id]
+
+        return await asyncio.to_thread(Job._get, job_id)
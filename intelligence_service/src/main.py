@@ -1,21 +1,23 @@
+import functools
 import logging
 import os
 from contextlib import asynccontextmanager
 from logging import Logger
-from typing import List, AsyncGenerator
+from typing import List, AsyncGenerator, Dict, Optional
 
 import sentry_sdk
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from cron_descriptor import get_description
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Query
 from fastapi.security import HTTPBearer
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
 
 import common
 from common import Constants
-from models import BaseOfficer, BaseIntelligence
+from job import JobQueue, Job
+from models import BaseOfficer, BaseIntelligence, UpsertStatistics
 from officer.http_archive import HTTPArchive
 from officer.http_blob import HTTPBlob
 from officer.jira import Jira
@@ -35,24 +37,30 @@ logger: Logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def update_intelligence(app: FastAPI) -> AsyncGenerator:
-    if not common.is_test_environment():
-        return
-
-    await common.wait_for_connection(Constants.VECTOR_EMBEDDING_SERVICE_URL.value)
-    for scheduled_task in HTTPBlob.get_scheduled_tasks() + HTTPArchive.get_scheduled_tasks() + Jira.get_scheduled_tasks():
-        scheduler.add_job(
-            scheduled_task.update_func,
-            trigger=CronTrigger.from_crontab(scheduled_task.update_schedule),
-            id=scheduled_task.name,
-            name=scheduled_task.name,
-            replace_existing=True
-        )
-        logger.debug(f"Added a task into the scheduler | {scheduled_task.name} | {scheduled_task.update_schedule} | {get_description(scheduled_task.update_schedule)}")
-    scheduler.start()
-
-    await HTTPBlob.update_on_startup()
-    await HTTPArchive.update_on_startup()
+    await JobQueue.start()
+    if common.is_test_environment():
+        await common.wait_for_connection(Constants.VECTOR_EMBEDDING_SERVICE_URL.value)
+        for scheduled_task in HTTPBlob.get_scheduled_tasks() + HTTPArchive.get_scheduled_tasks() + Jira.get_scheduled_tasks():
+            scheduler.add_job(
+                JobQueue.enqueue,
+                args=[scheduled_task.name, scheduled_task.update_func],
+                trigger=CronTrigger.from_crontab(scheduled_task.update_schedule),
+                id=scheduled_task.name,
+                name=scheduled_task.name,
+                replace_existing=True
+            )
+            logger.debug(f"Added a task into the scheduler | {scheduled_task.name} | {scheduled_task.update_schedule} | {get_description(scheduled_task.update_schedule)}")
+        scheduler.start()
+
+        await HTTPBlob.update_on_startup()
+        await HTTPArchive.update_on_startup()
+        await Jira.update_on_startup()
+
     yield
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await JobQueue.stop()
+    await common.HTTPClient.close()
 
 
 app = FastAPI(title="Vector Embedding Service API", lifespan=update_intelligence)
@@ -72,23 +80,37 @@ class AuthenticateToken(HTTPBearer):
 
 
 @app.get("/", dependencies=[Depends(AuthenticateToken())])
-async def get(query: str, index: str) -> List[BaseIntelligence]:
+async def get(query: str, index: List[str] = Query()) -> List[BaseIntelligence]:
     return await BaseOfficer.get(query, index)
 
 
 @app.post("/http_blob", dependencies=[Depends(AuthenticateToken())])
-async def upsert_http_blob(intelligence: BaseIntelligence) -> None:
-    await HTTPBlob.upsert(intelligence)
+async def upsert_http_blob(intelligence: BaseIntelligence) -> UpsertStatistics:
+    return await HTTPBlob.upsert(intelligence)
 
 
-@app.post("/http_archive", dependencies=[Depends(AuthenticateToken())])
-async def upsert_http_archive(intelligence: BaseIntelligence) -> None:
-    await HTTPArchive.upsert(intelligence)
+@app.post("/http_archive", status_code=202, dependencies=[Depends(AuthenticateToken())])
+async def upsert_http_archive(intelligence: BaseIntelligence) -> Job:
+    return await JobQueue.enqueue(f"HTTP Archive | {intelligence.index} | {intelligence.source}", functools.partial(HTTPArchive.upsert, intelligence))
 
 
 @app.post("/jira", dependencies=[Depends(AuthenticateToken())])
-async def upsert_jira(intelligence: BaseIntelligence) -> None:
-    await Jira.upsert(intelligence)
+async def upsert_jira(intelligence: BaseIntelligence) -> UpsertStatistics:
+    return await Jira.upsert(intelligence)
+
+
+@app.get("/jobs/{job_id}", dependencies=[Depends(AuthenticateToken())])
+async def get_job(job_id: str) -> Job:
+    job: Optional[Job] = await JobQueue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    return job
+
+
+@app.get("/metrics/http_client", dependencies=[Depends(AuthenticateToken())])
+async def get_http_client_statistics() -> Dict[str, int]:
+    return common.HTTPClient.get_statistics()
 
 
 if __name__ == "__main__":
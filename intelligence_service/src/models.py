@@ -1,16 +1,42 @@
+import asyncio
+import logging
+import os
 from abc import ABC, abstractmethod
-from typing import Optional, Any, Dict, List, Callable
+from enum import Enum
+from logging import Logger
+from typing import Optional, Any, Dict, List, Callable, AsyncIterable, Awaitable, Set
 
-import aiohttp
+from langchain_text_splitters import Language
 from pydantic import BaseModel
 
 import common
 from common import Constants
+from utility.chunking_utility import ChunkFormat, Chunk, get_chunk_format, get_chunk_list
+
+logger: Logger = logging.getLogger(__name__)
+DEFAULT_UPSERT_CONCURRENCY: int = int(os.getenv("INTELLIGENCE_SERVICE_UPSERT_CONCURRENCY") or 4)
+
+
+class UpsertStatus(str, Enum):
+    NEW = "new"
+    UPDATED = "updated"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+
+class UpsertStatistics(BaseModel):
+    new: int = 0
+    updated: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+    def add(self, status: UpsertStatus) -> None:
+        setattr(self, status.value, getattr(self, status.value) + 1)
 
 
 class BaseIntelligenceQuery(BaseModel):
     query: str
-    index: str
+    index_list: List[str]
 
 
 class BaseIntelligence(BaseModel, ABC):
@@ -25,25 +51,47 @@ class BaseIntelligence(BaseModel, ABC):
         if self.id is None and self.content is not None and self.content != "":
             self.id = common.get_sha256_hash(self.content)
 
-    async def upsert(self) -> None:
-        if self.id is None:
-            self.id = common.get_sha256_hash(self.content)
-
-        self.content = (f"# Source"
-                        f"\n{self.source}"
-                        f"\n\n# Description"
-                        f"\n{self.description}"
-                        f"\n\n# Content"
-                        f"\n{self.content}")
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{Constants.VECTOR_EMBEDDING_SERVICE_URL.value}/database", json={"source": self.source, "content": self.content, "index": self.index}) as response:
-                response.raise_for_status()
+    @staticmethod
+    async def _request_vector_embedding_service(method: str, path: str, json: Any) -> Any:
+        return await common.HTTPClient.request_json(method, f"{Constants.VECTOR_EMBEDDING_SERVICE_URL.value}{path}", json_data=json)
+
+    def get_chunk_format(self) -> ChunkFormat | Language:
+        return get_chunk_format(self.source)
+
+    async def upsert(self) -> UpsertStatus:
+        content: str = self.content or ""
+        chunk_list: List[Chunk] = await asyncio.to_thread(get_chunk_list, content, self.get_chunk_format()) or [Chunk(content=content, index=0, offset=0)]
+        header: str = (f"# Source"
+                       f"\n{self.source}"
+                       f"\n\n# Description"
+                       f"\n{self.description}"
+                       f"\n\n# Content\n")
+
+        #   Embedding ids are unique across every collection, so the index is part of the id for a source stored in several indexes
+        embedding_list: List[Dict[str, Any]] = [{
+            "id": common.get_sha256_hash(f"{self.index}#{self.source}#{chunk.index}"),
+            "source": self.source,
+            "content": header + chunk.content,
+            "index": self.index,
+            "metadata": {"chunk_index": chunk.index, "chunk_offset": chunk.offset, "chunk_count": len(chunk_list)},
+        } for chunk in chunk_list]
+        result_list: List[Dict[str, Any]] = await BaseIntelligence._request_vector_embedding_service("POST", "/database/batch", embedding_list)
+        status_set: Set[UpsertStatus] = {UpsertStatus(result["status"]) for result in result_list}
+        if UpsertStatus.FAILED in status_set:
+            logger.error(f"Failed to upsert: {self.source} | {[result['detail'] for result in result_list if result['status'] == UpsertStatus.FAILED.value][0]}")
+            return UpsertStatus.FAILED
+
+        #   Chunks left over from a longer previous version of the source would otherwise still be retrieved
+        delete_result: Dict[str, int] = await BaseIntelligence._request_vector_embedding_service("DELETE", "/database", {"index": self.index, "source": self.source, "keep_id_list": [embedding["id"] for embedding in embedding_list]})
+        if delete_result["deleted"] > 0:
+            status_set.add(UpsertStatus.UPDATED)
+
+        return status_set.pop() if len(status_set) == 1 else UpsertStatus.UPDATED
 
 
 class ScheduledTask(BaseModel):
     name: str
-    update_func: Callable
+    update_func: Callable[[UpsertStatistics], Awaitable[UpsertStatistics]]
     update_schedule: str
 
 
@@ -60,14 +108,42 @@ class BaseOfficer(BaseModel, ABC):
 
     @staticmethod
     @abstractmethod
-    async def upsert(intelligence: BaseIntelligence) -> None:
+    async def upsert(intelligence: BaseIntelligence, upsert_statistics: Optional[UpsertStatistics] = None) -> UpsertStatistics:
         pass
 
+    @staticmethod
+    async def upsert_all(intelligence_iterable: AsyncIterable[BaseIntelligence], concurrency: int = DEFAULT_UPSERT_CONCURRENCY, upsert_statistics: Optional[UpsertStatistics] = None) -> UpsertStatistics:
+        upsert_statistics = UpsertStatistics() if upsert_statistics is None else upsert_statistics
+        queue: asyncio.Queue[Optional[BaseIntelligence]] = asyncio.Queue(maxsize=concurrency * 2)
+
+        async def work() -> None:
+            while (intelligence := await queue.get()) is not None:
+                try:
+                    upsert_statistics.add(await intelligence.upsert())
+                except Exception as e:
+                    logger.error(f"Failed to upsert: {intelligence.source} | {str(e)}")
+                    upsert_statistics.add(UpsertStatus.FAILED)
+
+        worker_list: List[asyncio.Task] = [asyncio.create_task(work()) for _ in range(concurrency)]
+        try:
+            async for intelligence in intelligence_iterable:
+                await queue.put(intelligence)
+        except BaseException:
+            for worker in worker_list:
+                worker.cancel()
+            raise
+
+        for _ in worker_list:
+            await queue.put(None)
+        await asyncio.gather(*worker_list)
+
+        return upsert_statistics
+
     @classmethod
-    async def get(cls, query: str, index: str) -> List[BaseIntelligence]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{Constants.VECTOR_EMBEDDING_SERVICE_URL.value}/database", json={"input": query, "index": index}) as response:
-                response.raise_for_status()
-                data_list: List[Dict[str, Any]] = await response.json()
+    async def get(cls, query: str, index_list: List[str]) -> List[BaseIntelligence]:
+        #   All indexes are searched with a single embedding and query by the vector embedding service
+        async with common.HTTPClient.get_session().get(f"{Constants.VECTOR_EMBEDDING_SERVICE_URL.value}/database", json={"input": query, "index_list": index_list}) as response:
+            response.raise_for_status()
+            data_list: List[Dict[str, Any]] = await response.json()
 
         return [BaseIntelligence(**data) for data in data_list]
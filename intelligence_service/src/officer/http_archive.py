@@ -1,17 +1,19 @@
+import asyncio
+import functools
 import logging
-import os
 import tempfile
 import zipfile
 from logging import Logger
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, AsyncGenerator, IO, Optional
 
-import aiohttp
 import yaml
-from common import Constants
-from models import BaseOfficer, BaseIntelligence, ScheduledTask
+from common import Constants, HTTPClient
+from job import JobQueue
+from models import BaseOfficer, BaseIntelligence, ScheduledTask, UpsertStatistics, DEFAULT_UPSERT_CONCURRENCY
 from pydantic import BaseModel
 
 logger: Logger = logging.getLogger(__name__)
+DOWNLOAD_CHUNK_SIZE: int = 1024 * 1024
 
 
 class HTTPArchiveConfig(BaseModel):
@@ -21,6 +23,7 @@ class HTTPArchiveConfig(BaseModel):
     description: str
     update_schedule: str
     update_on_start_up: bool
+    concurrency: int = DEFAULT_UPSERT_CONCURRENCY
 
     @staticmethod
     def get() -> List["HTTPArchiveConfig"]:
@@ -36,74 +39,68 @@ class HTTPArchiveConfig(BaseModel):
 class HTTPArchive(BaseOfficer):
 
     @staticmethod
-    async def _get_file_bytes(url: str) -> bytes:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                return await response.read()
+    async def _download_file(url: str, file: IO[bytes]) -> None:
+        async with HTTPClient.get_session().get(url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
 
     @staticmethod
-    async def _get_file_archive_content(url: str) -> List[Tuple[str, str]]:
-        content: bytes = await HTTPArchive._get_file_bytes(url)
+    def _read_text_file(zip_file: zipfile.ZipFile, zip_info: zipfile.ZipInfo) -> Optional[str]:
+        with zip_file.open(zip_info) as file:
+            data: bytes = file.read()
 
-        with tempfile.TemporaryDirectory() as tmp_dir_name:
-            archive_path = os.path.join(tmp_dir_name, "archive.zip")
-            with open(archive_path, "wb") as f:
-                f.write(content)
+        if b"\x00" in data:
+            return None
 
-            extracted_files: List[Tuple[str, str]] = []
-            with zipfile.ZipFile(archive_path, "r") as zip_ref:
-                zip_ref.extractall(tmp_dir_name)
-                os.remove(archive_path)
+        try:
+            return data.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
 
-                for root, _, files in os.walk(tmp_dir_name):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        relative_path = os.path.relpath(file_path, tmp_dir_name)
-                        with open(file_path, "r", encoding="utf-8") as f_read:
-                            file_content = f_read.read()
+    @staticmethod
+    async def _get_file_archive_content(url: str) -> AsyncGenerator[Tuple[str, str], None]:
+        with tempfile.TemporaryFile() as archive_file:
+            await HTTPArchive._download_file(url, archive_file)
+
+            with zipfile.ZipFile(archive_file, "r") as zip_file:
+                for zip_info in zip_file.infolist():
+                    if zip_info.is_dir():
+                        continue
 
-                        extracted_files.append((relative_path, file_content))
+                    file_content: Optional[str] = await asyncio.to_thread(HTTPArchive._read_text_file, zip_file, zip_info)
+                    if file_content is None:
+                        logger.debug(f"Skipping binary or non UTF-8 file: {zip_info.filename}")
+                        continue
 
-        return extracted_files
+                    yield zip_info.filename, file_content
 
     @staticmethod
     def get_scheduled_tasks() -> List[ScheduledTask]:
-        scheduled_task_list: List[ScheduledTask] = []
-        for http_blob_config in HTTPArchiveConfig.get():
-            intelligence: BaseIntelligence = BaseIntelligence(source=http_blob_config.source, description=http_blob_config.description, index=http_blob_config.index)
-
-            async def update() -> None:
-                logger.info(f"Updating Index on Schedule: {http_blob_config.name} | {http_blob_config.index}")
-                await HTTPArchive.upsert(intelligence)
-                logger.info(f"Updating Index on Schedule completed: {http_blob_config.index}")
-
-            scheduled_task_list.append(ScheduledTask(
-                name=f"{http_blob_config.name} Updater",
-                update_func=update,
-                update_schedule=http_blob_config.update_schedule
-            ))
-
-        return scheduled_task_list
+        return [ScheduledTask(
+            name=f"{http_archive_config.name} Updater",
+            update_func=functools.partial(
+                HTTPArchive.upsert,
+                BaseIntelligence(source=http_archive_config.source, description=http_archive_config.description, index=http_archive_config.index),
+                concurrency=http_archive_config.concurrency
+            ),
+            update_schedule=http_archive_config.update_schedule
+        ) for http_archive_config in HTTPArchiveConfig.get()]
 
     @staticmethod
     async def update_on_startup() -> None:
-
-        for http_blob_config in HTTPArchiveConfig.get():
-            intelligence: BaseIntelligence = BaseIntelligence(source=http_blob_config.source, description=http_blob_config.description, index=http_blob_config.index)
-            if http_blob_config.update_on_start_up:
-                logger.info(f"Updating Index on Startup: {http_blob_config.name} | {http_blob_config.index}")
-                await HTTPArchive.upsert(intelligence)
-                logger.info(f"Updating Index on Startup completed: {http_blob_config.index}")
+        for http_archive_config, scheduled_task in zip(HTTPArchiveConfig.get(), HTTPArchive.get_scheduled_tasks()):
+            if http_archive_config.update_on_start_up:
+                logger.info(f"Updating Index on Startup: {http_archive_config.name} | {http_archive_config.index}")
+                await JobQueue.enqueue(scheduled_task.name, scheduled_task.update_func)
 
     @staticmethod
-    async def upsert(intelligence: BaseIntelligence) -> None:
+    async def upsert(intelligence: BaseIntelligence, upsert_statistics: Optional[UpsertStatistics] = None, concurrency: int = DEFAULT_UPSERT_CONCURRENCY) -> UpsertStatistics:
         if not isinstance(intelligence, BaseIntelligence):
             raise ValueError("The data is not valid: " + intelligence.model_dump_json())
 
-        content_list: List[Tuple[str, str]] = await HTTPArchive._get_file_archive_content(intelligence.source)
-        for content in content_list:
-            intelligence.source = content[0]
-            intelligence.content = content[1]
+        async def get_intelligence_iterable() -> AsyncGenerator[BaseIntelligence, None]:
+            async for source, content in HTTPArchive._get_file_archive_content(intelligence.source):
+                yield intelligence.model_copy(update={"id": None, "source": source, "content": content})
 
-            await intelligence.upsert()
+        return await BaseOfficer.upsert_all(get_intelligence_iterable(), concurrency, upsert_statistics)
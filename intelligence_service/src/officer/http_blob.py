@@ -1,11 +1,12 @@
+import functools
 import logging
 from logging import Logger
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Optional
 
-import aiohttp
 import yaml
-from common import Constants
-from models import BaseOfficer, BaseIntelligence, ScheduledTask
+from common import Constants, HTTPClient
+from job import JobQueue
+from models import BaseOfficer, BaseIntelligence, ScheduledTask, UpsertStatistics
 from pydantic import BaseModel
 
 logger: Logger = logging.getLogger(__name__)
@@ -34,47 +35,34 @@ class HTTPBlob(BaseOfficer):
 
     @staticmethod
     async def _get_file_content(url: str) -> str:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                data: bytes = await response.read()
+        async with HTTPClient.get_session().get(url) as response:
+            response.raise_for_status()
+            data: bytes = await response.read()
 
         return data.decode("utf-8")
 
     @staticmethod
     def get_scheduled_tasks() -> List[ScheduledTask]:
-        scheduled_task_list: List[ScheduledTask] = []
-        for http_blob_config in HTTPBlobConfig.get():
-            intelligence: BaseIntelligence = BaseIntelligence(source=http_blob_config.source, description=http_blob_config.description, index=http_blob_config.index)
-
-            async def update() -> None:
-                logger.info(f"Updating Index on Schedule: {http_blob_config.name} | {http_blob_config.index}")
-                logger.info(f"Updating Index on Schedule: {http_blob_config.name} | {http_blob_config.index}")
-                await HTTPBlob.upsert(intelligence)
-                logger.info(f"Updating Index on Schedule completed: {http_blob_config.name} | {http_blob_config.index}")
-
-            scheduled_task_list.append(ScheduledTask(
-                name=f"{http_blob_config.name} Updater",
-                update_func=update,
-                update_schedule=http_blob_config.update_schedule
-            ))
-
-        return scheduled_task_list
+        return [ScheduledTask(
+            name=f"{http_blob_config.name} Updater",
+            update_func=functools.partial(HTTPBlob.upsert, BaseIntelligence(source=http_blob_config.source, description=http_blob_config.description, index=http_blob_config.index)),
+            update_schedule=http_blob_config.update_schedule
+        ) for http_blob_config in HTTPBlobConfig.get()]
 
     @staticmethod
     async def update_on_startup() -> None:
-
-        for http_blob_config in HTTPBlobConfig.get():
-            intelligence: BaseIntelligence = BaseIntelligence(source=http_blob_config.source, description=http_blob_config.description, index=http_blob_config.index)
+        for http_blob_config, scheduled_task in zip(HTTPBlobConfig.get(), HTTPBlob.get_scheduled_tasks()):
             if http_blob_config.update_on_start_up:
                 logger.info(f"Updating Index on Startup: {http_blob_config.name} | {http_blob_config.index}")
-                await HTTPBlob.upsert(intelligence)
-                logger.info(f"Updating Index on Startup completed: {http_blob_config.name} | {http_blob_config.index}")
+                await JobQueue.enqueue(scheduled_task.name, scheduled_task.update_func)
 
     @staticmethod
-    async def upsert(intelligence: BaseIntelligence) -> None:
+    async def upsert(intelligence: BaseIntelligence, upsert_statistics: Optional[UpsertStatistics] = None) -> UpsertStatistics:
         if not isinstance(intelligence, BaseIntelligence):
             raise ValueError("The data is not valid: " + intelligence.model_dump_json())
 
-        intelligence.content = await HTTPBlob._get_file_content(intelligence.source) if intelligence.content is None else intelligence.content
-        await intelligence.upsert()
+        #   Scheduled updates reuse the same intelligence, so the fetched content is kept on a copy
+        intelligence = intelligence.model_copy(update={"content": await HTTPBlob._get_file_content(intelligence.source) if intelligence.content is None else intelligence.content})
+        upsert_statistics = UpsertStatistics() if upsert_statistics is None else upsert_statistics
+        upsert_statistics.add(await intelligence.upsert())
+        return upsert_statistics
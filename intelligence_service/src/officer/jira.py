@@ -1,17 +1,27 @@
+import asyncio
+import functools
 import logging
+import math
 import os
+import time
 from logging import Logger
-from typing import List, Dict, Any, Optional
-from urllib.parse import urlparse
+from typing import List, Dict, Any, Optional, AsyncGenerator
+from urllib.parse import urlparse, ParseResult
 
 import yaml
+from langchain_text_splitters import Language
+import common
 from common import Constants
-from models import BaseOfficer, BaseIntelligence, ScheduledTask
-from pydantic import BaseModel
+from job import JobQueue
+from models import BaseOfficer, BaseIntelligence, ScheduledTask, UpsertStatistics, DEFAULT_UPSERT_CONCURRENCY
+from pydantic import BaseModel, ValidationError
 
+from utility.chunking_utility import ChunkFormat
 from utility.jira_utility import Issue
 
 logger: Logger = logging.getLogger(__name__)
+#   Overlap between syncs, as the watermark is applied with minute precision and the clocks may differ
+JIRA_WATERMARK_OVERLAP_MINUTES: int = int(os.getenv("INTELLIGENCE_SERVICE_JIRA_WATERMARK_OVERLAP_MINUTES") or 5)
 
 
 class JiraConfig(BaseModel):
@@ -23,16 +33,34 @@ class JiraConfig(BaseModel):
     update_schedule: str
     update_on_start_up: bool
     api_key: str
+    concurrency: int = DEFAULT_UPSERT_CONCURRENCY
 
     @staticmethod
     def get() -> List["JiraConfig"]:
         with open(f"{Constants.DATA_PATH.value}jira.yml", "r") as raw_string:
             raw_data_list: List[Dict[str, Any]] = yaml.safe_load(raw_string) or []
 
+        jira_config_list: List[JiraConfig] = []
         for raw_data in raw_data_list:
-            raw_data["api_key"] = raw_data.get("api_key") or os.getenv(raw_data.get("api_key_environment_variable_key"))
+            api_key_environment_variable_key: Optional[str] = raw_data.get("api_key_environment_variable_key")
+            raw_data["api_key"] = raw_data.get("api_key") or (os.getenv(api_key_environment_variable_key) if api_key_environment_variable_key is not None else None)
 
-        return [JiraConfig(**raw_data) for raw_data in raw_data_list]
+            #   A Jira without an API key cannot be synced, it is skipped so that the other officers still start
+            if raw_data["api_key"] is None:
+                logger.warning(f"Skipping the Jira configuration as no API key is set | {raw_data.get('name')} | {api_key_environment_variable_key}")
+                continue
+
+            try:
+                jira_config_list.append(JiraConfig(**raw_data))
+            except ValidationError as e:
+                logger.warning(f"Skipping the invalid Jira configuration | {raw_data.get('name')} | {str(e)}")
+
+        return jira_config_list
+
+
+class JiraIntelligence(BaseIntelligence):
+    def get_chunk_format(self) -> ChunkFormat | Language:
+        return ChunkFormat.JIRA
 
 
 class Jira(BaseOfficer):
@@ -53,20 +81,64 @@ class Jira(BaseOfficer):
 
         return await Issue.get_from_jql(jql, base_url, source_config.api_key)
 
+    @staticmethod
+    def _get_watermark(name: str) -> Optional[float]:
+        with common.get_database_connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS jira_watermark (name TEXT PRIMARY KEY, synced_at REAL NOT NULL)")
+            row: Optional[Any] = connection.execute("SELECT synced_at FROM jira_watermark WHERE name = ?", (name,)).fetchone()
+
+        return row["synced_at"] if row is not None else None
+
+    @staticmethod
+    def _set_watermark(name: str, synced_at: float) -> None:
+        with common.get_database_connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO jira_watermark (name, synced_at) VALUES (?, ?)", (name, synced_at))
+
+    @staticmethod
+    async def sync(jira_config: JiraConfig, upsert_statistics: Optional[UpsertStatistics] = None) -> UpsertStatistics:
+        started_at: float = time.time()
+        watermark: Optional[float] = await asyncio.to_thread(Jira._get_watermark, jira_config.name)
+
+        #   A relative JQL duration avoids depending on the timezone of the Jira user
+        jql: str = jira_config.jql
+        if watermark is not None:
+            jql = f"({jql}) AND updated >= -{math.ceil((started_at - watermark) / 60) + JIRA_WATERMARK_OVERLAP_MINUTES}m"
+
+        base_url: ParseResult = urlparse(jira_config.base_url)
+
+        async def get_intelligence_iterable() -> AsyncGenerator[BaseIntelligence, None]:
+            async for issue in Issue.get_all_from_jql(jql, jira_config.base_url, jira_config.api_key):
+                yield JiraIntelligence(source=f"{base_url.scheme}://{base_url.netloc}/browse/{issue.id}", content=str(issue), description=jira_config.description, index=jira_config.index)
+
+        upsert_statistics = await BaseOfficer.upsert_all(get_intelligence_iterable(), jira_config.concurrency, upsert_statistics)
+
+        #   The watermark only moves forward when every issue was stored, so that failed issues are retried on the next sync
+        if upsert_statistics.failed == 0:
+            await asyncio.to_thread(Jira._set_watermark, jira_config.name, started_at)
+
+        return upsert_statistics
+
     @staticmethod
     def get_scheduled_tasks() -> List[ScheduledTask]:
-        #   TODO
-        return []
+        return [ScheduledTask(
+            name=f"{jira_config.name} Updater",
+            update_func=functools.partial(Jira.sync, jira_config),
+            update_schedule=jira_config.update_schedule
+        ) for jira_config in JiraConfig.get()]
 
     @staticmethod
     async def update_on_startup() -> None:
-        #   TODO
-        pass
+        for jira_config, scheduled_task in zip(JiraConfig.get(), Jira.get_scheduled_tasks()):
+            if jira_config.update_on_start_up:
+                logger.info(f"Updating Index on Startup: {jira_config.name} | {jira_config.index}")
+                await JobQueue.enqueue(scheduled_task.name, scheduled_task.update_func)
 
     @staticmethod
-    async def upsert(intelligence: BaseIntelligence) -> None:
+    async def upsert(intelligence: BaseIntelligence, upsert_statistics: Optional[UpsertStatistics] = None) -> UpsertStatistics:
         if not isinstance(intelligence, BaseIntelligence):
             raise ValueError("The data is not valid: " + intelligence.model_dump_json())
 
-        intelligence.content = str(await Jira._get_ticket_content(intelligence.source) if intelligence.content is None else intelligence.content)
-        await intelligence.upsert()
+        content: str = str(await Jira._get_ticket_content(intelligence.source) if intelligence.content is None else intelligence.content)
+        upsert_statistics = UpsertStatistics() if upsert_statistics is None else upsert_statistics
+        upsert_statistics.add(await JiraIntelligence(**intelligence.model_dump() | {"content": content}).upsert())
+        return upsert_statistics
@@ -0,0 +1,81 @@
+import os
+from enum import Enum
+from functools import lru_cache
+from typing import List, Dict, Optional
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
+from pydantic import BaseModel
+
+CHUNK_SIZE: int = int(os.getenv("INTELLIGENCE_SERVICE_CHUNK_SIZE") or 512)
+CHUNK_OVERLAP: int = int(os.getenv("INTELLIGENCE_SERVICE_CHUNK_OVERLAP") or 64)
+CHUNK_ENCODING: str = os.getenv("INTELLIGENCE_SERVICE_CHUNK_ENCODING") or "cl100k_base"
+
+#   Splits on the boundaries written by Issue.__str__, so that a comment is only cut when it exceeds a chunk by itself
+JIRA_SEPARATOR_LIST: List[str] = ["\n---\n## Author's Name", "\n# Comments", "\n# ", "\n\n", "\n", " ", ""]
+EXTENSION_LANGUAGE_DICT: Dict[str, Language] = {
+    "md": Language.MARKDOWN, "markdown": Language.MARKDOWN,
+    "py": Language.PYTHON,
+    "js": Language.JS, "jsx": Language.JS, "mjs": Language.JS,
+    "ts": Language.TS, "tsx": Language.TS,
+    "java": Language.JAVA,
+    "kt": Language.KOTLIN, "kts": Language.KOTLIN,
+    "go": Language.GO,
+    "rs": Language.RUST,
+    "c": Language.C, "h": Language.C,
+    "cpp": Language.CPP, "cc": Language.CPP, "hpp": Language.CPP,
+    "cs": Language.CSHARP,
+    "rb": Language.RUBY,
+    "php": Language.PHP,
+    "scala": Language.SCALA,
+    "swift": Language.SWIFT,
+    "proto": Language.PROTO,
+    "rst": Language.RST,
+    "tex": Language.LATEX,
+    "html": Language.HTML, "htm": Language.HTML,
+    "sol": Language.SOL,
+    "lua": Language.LUA,
+    "pl": Language.PERL,
+    "hs": Language.HASKELL,
+    "ex": Language.ELIXIR, "exs": Language.ELIXIR,
+    "ps1": Language.POWERSHELL,
+}
+
+
+class ChunkFormat(str, Enum):
+    TEXT = "text"
+    JIRA = "jira"
+
+
+class Chunk(BaseModel):
+    content: str
+    index: int
+    offset: int
+
+
+@lru_cache
+def _get_text_splitter(chunk_format: ChunkFormat | Language) -> RecursiveCharacterTextSplitter:
+    separator_list: Optional[List[str]] = None
+    if chunk_format == ChunkFormat.JIRA:
+        separator_list = JIRA_SEPARATOR_LIST
+    elif isinstance(chunk_format, Language):
+        separator_list = RecursiveCharacterTextSplitter.get_separators_for_language(chunk_format)
+
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name=CHUNK_ENCODING,
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=separator_list,
+        is_separator_regex=isinstance(chunk_format, Language),
+        add_start_index=True,
+    )
+
+
+def get_chunk_format(source: str) -> ChunkFormat | Language:
+    extension: str = source.rsplit("/", 1)[-1].rsplit(".", 1)[-1].lower() if "." in source.rsplit("/", 1)[-1] else ""
+    return EXTENSION_LANGUAGE_DICT.get(extension, ChunkFormat.TEXT)
+
+
+def get_chunk_list(text: str, chunk_format: ChunkFormat | Language) -> List[Chunk]:
+    document_list: List[Document] = _get_text_splitter(chunk_format).create_documents([text])
+    return [Chunk(content=document.page_content, index=i, offset=document.metadata["start_index"]) for i, document in enumerate(document_list)]
@@ -1,11 +1,20 @@
+import asyncio
+import os
 import urllib
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncGenerator
 
 from pydantic import BaseModel
 
 from utility.common_utility import get_raw_http_data
 
+JIRA_SEARCH_PAGE_SIZE: int = int(os.getenv("INTELLIGENCE_SERVICE_JIRA_SEARCH_PAGE_SIZE") or 100)
+JIRA_FETCH_CONCURRENCY: int = int(os.getenv("INTELLIGENCE_SERVICE_JIRA_FETCH_CONCURRENCY") or 4)
+ISSUE_FIELD_LIST: List[str] = [
+    "issuetype", "assignee", "creator", "status", "security", "description", "comment", "updated",
+    "customfield_10710", "customfield_12010", "customfield_11710", "customfield_12510", "customfield_12511", "customfield_12772", "customfield_12773", "customfield_12774",
+]
+
 
 def _get_headers(api_key: str) -> Dict[str, Any]:
     return {"Accept": "application/json", "Authorization": f"Basic {api_key}"}
@@ -137,17 +146,52 @@ class Issue(BaseModel):
 """
 
     @staticmethod
-    async def _get_all_issues_raw(jql: str, base_url: str, api_key: str) -> List[Dict[str, Any]]:
+    async def _get_issues_page_raw(jql: str, base_url: str, api_key: str, start_at: int) -> Dict[str, Any]:
         encoded_jql: str = urllib.parse.quote(jql)
-        url: str = f"{base_url}/search?jql={encoded_jql}"
-        raw_data: Dict[str, Any] = await get_raw_http_data(url, _get_headers(api_key))
-        return raw_data["issues"]
+        url: str = f"{base_url}/search?jql={encoded_jql}&startAt={start_at}&maxResults={JIRA_SEARCH_PAGE_SIZE}&fields={','.join(ISSUE_FIELD_LIST)}"
+        raw_data: Dict[str, Any] | List[Any] = await get_raw_http_data(url, _get_headers(api_key))
+        if not isinstance(raw_data, dict):
+            raise ValueError(f"Unexpected Jira search response | {base_url} | {type(raw_data).__name__}")
+
+        return raw_data
 
     @staticmethod
-    async def get_from_issue_id(issue_id: str, base_url: str, api_key: str) -> "Issue":
-        url: str = f"{base_url}/issue/{issue_id}"
-        raw_data: Dict[str, Any] = await get_raw_http_data(url, _get_headers(api_key))
+    async def _get_all_issues_raw(jql: str, base_url: str, api_key: str) -> AsyncGenerator[Dict[str, Any], None]:
+        first_page: Dict[str, Any] = await Issue._get_issues_page_raw(jql, base_url, api_key, 0)
+        for data in first_page["issues"]:
+            yield data
+
+        #   Jira can cap maxResults below the requested page size, so the pages follow the size of the first page that was returned
+        total: int = first_page["total"]
+        page_size: int = min(first_page.get("maxResults") or len(first_page["issues"]), len(first_page["issues"]))
+
+        #   The total is known after the first page, so the remaining pages are fetched concurrently
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(JIRA_FETCH_CONCURRENCY)
+
+        async def get_page(start_at: int) -> List[Dict[str, Any]]:
+            end_at: int = min(start_at + page_size, total)
+            issue_list: List[Dict[str, Any]] = []
+            async with semaphore:
+                #   A page that comes back short is completed from where it stopped, so that no issue of its range is skipped
+                while start_at + len(issue_list) < end_at:
+                    page: Dict[str, Any] = await Issue._get_issues_page_raw(jql, base_url, api_key, start_at + len(issue_list))
+                    if len(page["issues"]) == 0:
+                        break
+                    issue_list.extend(page["issues"])
+
+            return issue_list[:end_at - start_at]
+
+        page_task_list: List[asyncio.Task] = [asyncio.create_task(get_page(start_at)) for start_at in range(page_size, total, page_size)] if page_size > 0 else []
+        try:
+            for page_task in asyncio.as_completed(page_task_list):
+                for data in await page_task:
+                    yield data
+        finally:
+            for page_task in page_task_list:
+                page_task.cancel()
 
+    @staticmethod
+    def _get_from_raw_issue(issue_id: str, raw_data: Dict[str, Any]) -> "Issue":
         return Issue(
             id=issue_id,
             type=raw_data["fields"]['issuetype']['name'],
@@ -174,7 +218,20 @@ class Issue(BaseModel):
         )
 
     @staticmethod
-    async def get_from_jql(jql: str, base_url: str, api_key: str) -> List["Issue"]:
-        data_list: List[Dict[str, Any]] = await Issue._get_all_issues_raw(jql)
+    async def get_from_issue_id(issue_id: str, base_url: str, api_key: str) -> "Issue":
+        url: str = f"{base_url}/issue/{issue_id}?fields={','.join(ISSUE_FIELD_LIST)}"
+        raw_data: Dict[str, Any] = await get_raw_http_data(url, _get_headers(api_key))
+        return Issue._get_from_raw_issue(issue_id, raw_data)
+
+    @staticmethod
+    async def get_all_from_jql(jql: str, base_url: str, api_key: str) -> AsyncGenerator["Issue", None]:
+        async for data in Issue._get_all_issues_raw(jql, base_url, api_key):
+            #   Search results only embed the first page of comments, so those issues are fetched in full
+            if data["fields"]["comment"]["total"] > len(data["fields"]["comment"]["comments"]):
+                yield await Issue.get_from_issue_id(data["key"], base_url, api_key)
+            else:
+                yield Issue._get_from_raw_issue(data["key"], data)
 
-        return [await Issue.get_from_issue_id(data["key"], base_url, api_key) for data in data_list]
+    @staticmethod
+    async def get_from_jql(jql: str, base_url: str, api_key: str) -> List["Issue"]:
+        return [issue async for issue in Issue.get_all_from_jql(jql, base_url, api_key)]
@@ -1,11 +1,18 @@
-from typing import Any, Dict
+import asyncio
+import base64
+import json
+import time
+import uuid
+from typing import Any, Dict, List
 
 import aiohttp
 import pytest
 
+from src import common
 from src.models import BaseIntelligence
 
 BASE_URL: str = "http://0.0.0.0:8002"
+JOB_TIMEOUT: int = 600
 
 
 @pytest.mark.asyncio
@@ -29,13 +36,37 @@ async def test_get_http_blob() -> None:
             assert len(data) > 1
 
 
+@pytest.mark.asyncio
+async def test_get_from_multiple_indexes() -> None:
+    url: str = f"{BASE_URL}/"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, params=[("query", "Are imports missing?"), ("index", "TEST"), ("index", "TEST_SECONDARY")]) as response:
+            data: Any = await response.json()
+            print(data)
+            assert response.status == 200
+            assert {intelligence["index"] for intelligence in data} <= {"TEST", "TEST_SECONDARY"}
+
+
 @pytest.mark.asyncio
 async def test_upsert_http_archive() -> None:
     url: str = f"{BASE_URL}/http_archive"
 
     async with aiohttp.ClientSession() as session:
         async with session.post(url, json=BaseIntelligence(source="https://codeload.github.com/lieutenant-ecosystem/lieutenant/zip/refs/heads/main", index="TEST").model_dump()) as response:
-            assert response.status == 200
+            assert response.status == 202
+            job: Dict[str, Any] = await response.json()
+
+        for _ in range(JOB_TIMEOUT):
+            async with session.get(f"{BASE_URL}/jobs/{job['id']}") as response:
+                assert response.status == 200
+                job = await response.json()
+            if job["status"] in ("done", "failed"):
+                break
+            await asyncio.sleep(1)
+
+        assert job["status"] == "done"
+        assert job["statistics"]["failed"] == 0
 
 
 @pytest.mark.asyncio
@@ -56,3 +87,32 @@ async def test_get_http_archive() -> None:
             data = await response.json()
             print(data)
             assert len(data) > 0
+
+
+def _get_jwt_segment(data: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).rstrip(b"=").decode("utf-8")
+
+
+@pytest.mark.asyncio
+async def test_is_valid_jwt_token_rejects_malformed_and_expired_tokens(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(common, "JWT_SECRET", None)
+    header_segment: str = _get_jwt_segment({"alg": "HS256", "typ": "JWT"})
+
+    assert not await common.is_valid_jwt_token("a.MQ.b")
+    assert not await common.is_valid_jwt_token("a.eyJleHAiOiJ4In0.b")
+    assert not await common.is_valid_jwt_token(f"{header_segment}.{_get_jwt_segment({'exp': time.time() - 60})}.b")
+
+    monkeypatch.setattr(common, "JWT_SECRET", "secret")
+    assert not await common.is_valid_jwt_token(f"MQ.{_get_jwt_segment({'exp': time.time() + 60})}.b")
+
+
+@pytest.mark.asyncio
+async def test_is_valid_jwt_token_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(common, "JWT_SECRET", None)
+    jwt_token_list: List[str] = [f"cached-token-{uuid.uuid4()}", f"cached-token-{uuid.uuid4()}"]
+    for jwt_token in jwt_token_list:
+        common._jwt_validation_cache[common.get_sha256_hash(jwt_token)] = (True, time.time() + 60)
+
+    #   A cached token is answered without Open WebUI and becomes the most recently used entry
+    assert await common.is_valid_jwt_token(jwt_token_list[0])
+    assert next(reversed(common._jwt_validation_cache)) == common.get_sha256_hash(jwt_token_list[0])
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from logging import Logger
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+import common
+from models import ChatCompletionResponse
+from vector_store import VectorStore
+
+logger: Logger = logging.getLogger(__name__)
+RESPONSE_CACHE_MAX_SIZE: int = int(os.getenv("SERGEANT_SERVICE_RESPONSE_CACHE_MAX_SIZE") or 1000)
+RESPONSE_CACHE_SHARED: bool = os.getenv("SERGEANT_SERVICE_RESPONSE_CACHE_SHARED") == "true"
+RESPONSE_CACHE_PURGE_INTERVAL: int = int(os.getenv("SERGEANT_SERVICE_RESPONSE_CACHE_PURGE_INTERVAL") or 1000)
+
+
+class ResponseCache:
+    _memory_cache: OrderedDict[str, Tuple[ChatCompletionResponse, float]] = OrderedDict()
+    _is_table_created: bool = False
+    _lock: asyncio.Lock = asyncio.Lock()
+    _set_count: int = 0
+    _statistics: Dict[str, int] = {
+        "memory_hit_count": 0,
+        "shared_hit_count": 0,
+        "miss_count": 0,
+        "shared_error_count": 0,
+    }
+
+    @staticmethod
+    def get_key(model: str, parent_model_id: str, messages: List[Dict[str, str]], temperature: Optional[float], max_tokens: Optional[int]) -> str:
+        #   The retrieved context is part of the messages, so a change in the indexes results in a different key
+        #   The parent model is part of the key, so that a reload that moves the model to another parent model does not serve the old answers
+        return common.get_sha256_hash(json.dumps({
+            "model": model,
+            "parent_model_id": parent_model_id,
+            "messages": [{"role": message["role"], "content": " ".join(message["content"].split())} for message in messages],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }, sort_keys=True))
+
+    @staticmethod
+    async def _create_table() -> None:
+        if ResponseCache._is_table_created:
+            return
+
+        async with ResponseCache._lock:
+            if not ResponseCache._is_table_created:
+                async with VectorStore.get_engine().begin() as connection:
+                    await connection.execute(text("CREATE TABLE IF NOT EXISTS sergeant_response_cache (key TEXT PRIMARY KEY, response JSONB NOT NULL, expires_at DOUBLE PRECISION NOT NULL)"))
+                    await connection.execute(text("DELETE FROM sergeant_response_cache WHERE expires_at <= :now"), {"now": time.time()})
+                ResponseCache._is_table_created = True
+
+    @staticmethod
+    async def _get_from_shared(key: str) -> Optional[Tuple[ChatCompletionResponse, float]]:
+        await ResponseCache._create_table()
+        async with VectorStore.get_engine().connect() as connection:
+            row = (await connection.execute(
+                text("SELECT response, expires_at FROM sergeant_response_cache WHERE key = :key AND expires_at > :now"),
+                {"key": key, "now": time.time()}
+            )).first()
+
+        return (ChatCompletionResponse(**row[0]), row[1]) if row is not None else None
+
+    @staticmethod
+    async def _set_to_shared(key: str, response: ChatCompletionResponse, expires_at: float) -> None:
+        await ResponseCache._create_table()
+        async with VectorStore.get_engine().begin() as connection:
+            await connection.execute(
+                text("INSERT INTO sergeant_response_cache (key, response, expires_at) VALUES (:key, CAST(:response AS JSONB), :expires_at) "
+                     "ON CONFLICT (key) DO UPDATE SET response = EXCLUDED.response, expires_at = EXCLUDED.expires_at"),
+                {"key": key, "response": response.model_dump_json(), "expires_at": expires_at}
+            )
+
+            #   Expired rows are otherwise only replaced when the same key is cached again
+            ResponseCache._set_count += 1
+            if ResponseCache._set_count % RESPONSE_CACHE_PURGE_INTERVAL == 0:
+                await connection.execute(text("DELETE FROM sergeant_response_cache WHERE expires_at <= :now"), {"now": time.time()})
+
+    @staticmethod
+    def _set_to_memory(key: str, response: ChatCompletionResponse, expires_at: float) -> None:
+        ResponseCache._memory_cache[key] = (response, expires_at)
+        ResponseCache._memory_cache.move_to_end(key)
+        while len(ResponseCache._memory_cache) > RESPONSE_CACHE_MAX_SIZE:
+            ResponseCache._memory_cache.popitem(last=False)
+
+    @staticmethod
+    async def get(key: str) -> Optional[ChatCompletionResponse]:
+        entry: Optional[Tuple[ChatCompletionResponse, float]] = ResponseCache._memory_cache.get(key)
+        if entry is not None and entry[1] > time.time():
+            ResponseCache._memory_cache.move_to_end(key)
+            ResponseCache._statistics["memory_hit_count"] += 1
+            return entry[0]
+        elif entry is not None:
+            ResponseCache._memory_cache.pop(key, None)
+            entry = None
+
+        if RESPONSE_CACHE_SHARED:
+            #   The shared tier is an optimisation, an unavailable database is treated as a miss
+            try:
+                entry = await ResponseCache._get_from_shared(key)
+            except SQLAlchemyError as e:
+                ResponseCache._statistics["shared_error_count"] += 1
+                logger.warning(f"Unable to read the shared response cache | {str(e)}")
+
+            if entry is not None:
+                ResponseCache._set_to_memory(key, *entry)
+                ResponseCache._statistics["shared_hit_count"] += 1
+                return entry[0]
+
+        ResponseCache._statistics["miss_count"] += 1
+        return None
+
+    @staticmethod
+    async def set(key: str, response: ChatCompletionResponse, ttl: float) -> None:
+        expires_at: float = time.time() + ttl
+        ResponseCache._set_to_memory(key, response, expires_at)
+
+        if RESPONSE_CACHE_SHARED:
+            try:
+                await ResponseCache._set_to_shared(key, response, expires_at)
+            except SQLAlchemyError as e:
+                ResponseCache._statistics["shared_error_count"] += 1
+                logger.warning(f"Unable to write the shared response cache | {str(e)}")
+
+    @staticmethod
+    def get_statistics() -> Dict[str, int]:
+        return ResponseCache._statistics | {"memory_size": len(ResponseCache._memory_cache)}
@@ -0,0 +1,59 @@
+import os
+from typing import List, Set
+
+from langchain_core.documents import Document
+from pydantic import BaseModel
+
+import common
+
+DEFAULT_CONTEXT_TOKEN_BUDGET: int = int(os.getenv("SERGEANT_SERVICE_CONTEXT_TOKEN_BUDGET") or 4000)
+
+
+class RetrievedContext(BaseModel):
+    content: str = ""
+    document_count: int = 0
+    token_count: int = 0
+
+    @staticmethod
+    def _get_section(document: Document) -> str:
+        return (f"# Data"
+                f"\n{document.page_content}"
+                f"\n# Metadata"
+                f"\n## Source"
+                f"\n{document.metadata.get('source')}\n")
+
+    @staticmethod
+    def _get_unique_document_list(document_list: List[Document]) -> List[Document]:
+        seen_key_set: Set[str] = set()
+        unique_document_list: List[Document] = []
+        for document in document_list:
+            key_list: List[str] = [common.get_sha256_hash(document.page_content)] + ([document.id] if document.id is not None else [])
+            if any(key in seen_key_set for key in key_list):
+                continue
+
+            seen_key_set.update(key_list)
+            unique_document_list.append(document)
+
+        return unique_document_list
+
+    @staticmethod
+    def get(document_list: List[Document], token_budget: int, model: str) -> "RetrievedContext":
+        #   Scored documents first by descending score, unscored ones keep their retrieval rank (the sort is stable)
+        #   Ranking happens before deduplication so that the best scoring copy of a document is the one kept
+        ranked_document_list: List[Document] = RetrievedContext._get_unique_document_list(sorted(
+            document_list,
+            key=lambda d: (d.metadata.get("score") is None, -(d.metadata.get("score") or 0))
+        ))
+
+        section_list: List[str] = []
+        token_count: int = 0
+        for document in ranked_document_list:
+            section: str = RetrievedContext._get_section(document)
+            section_token_count: int = common.get_token_count(section, model)
+            if token_count + section_token_count > token_budget:
+                continue
+
+            section_list.append(section)
+            token_count += section_token_count
+
+        return RetrievedContext(content="".join(section_list), document_count=len(section_list), token_count=token_count)
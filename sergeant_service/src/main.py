@@ -1,19 +1,21 @@
 import logging
 import os
-import time
-from typing import List, Dict
+from contextlib import asynccontextmanager
+from typing import List, Dict, AsyncGenerator, Optional, Any
 
 import sentry_sdk
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import HTTPBearer
 from starlette.requests import Request
-from starlette.responses import StreamingResponse
+from starlette.responses import StreamingResponse, Response
 
 import common
+from cache import ResponseCache
 from models import ChatCompletionRequest, ChatCompletionResponse
+from registry import SergeantRegistry
+from semantic_cache import SemanticCache, SemanticCacheLookup
 from sergeant import Sergeant
-
-start_up_time: int = int(time.time())
+from vector_store import VectorStore
 
 if os.getenv("SENTRY_DSN"):
     sentry_sdk.init(
@@ -21,11 +23,22 @@ if os.getenv("SENTRY_DSN"):
         traces_sample_rate=1.0,
         _experiments={"continuous_profiling_auto_start": True, },
     )
-app = FastAPI(title="Lieutenant API")
 logging.basicConfig(level=logging.DEBUG if common.is_test_environment() else logging.INFO,
                     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncGenerator:
+    await SergeantRegistry.start()
+    yield
+    await SergeantRegistry.stop()
+    await VectorStore.close()
+    await common.HTTPClient.close()
+
+
+app = FastAPI(title="Lieutenant API", lifespan=lifespan)
+
+
 class AuthenticateToken(HTTPBearer):
     def __init__(self, auto_error: bool = True):
         super(AuthenticateToken, self).__init__(auto_error=auto_error)
@@ -39,31 +52,85 @@ class AuthenticateToken(HTTPBearer):
 
 
 @app.post("/chat/completions", dependencies=[Depends(AuthenticateToken())], response_model=None)
-async def chat_completions(request: ChatCompletionRequest) -> StreamingResponse | ChatCompletionResponse:
-    sergeant: Sergeant = Sergeant.get(request.model)
-    sergeant.model.temperature = request.temperature
-    sergeant.model.max_tokens = request.max_tokens
+async def chat_completions(request: ChatCompletionRequest, response: Response) -> StreamingResponse | ChatCompletionResponse:
+    sergeant: Optional[Sergeant] = SergeantRegistry.get(request.model)
+    if sergeant is None:
+        raise HTTPException(status_code=404, detail=f"Model not found: {request.model}")
+
     messages: List[Dict[str, str]] = Sergeant.get_messages(request, sergeant)
 
     try:
-        if len(sergeant.llm_config.index_list) > 0:
-            sergeant.add_context_from_indexes(messages)
-
+        #   Streaming responses are opened straight away and retrieve the context inside the stream
         if request.stream:
             return sergeant.ask_stream(messages, request)
-        else:
-            return await sergeant.ask(messages)
+
+        #   Paraphrases are looked up before retrieval, the index versions already tell whether a cached answer is stale
+        semantic_cache_lookup: Optional[SemanticCacheLookup] = await sergeant.get_semantic_cache_lookup(messages)
+        if semantic_cache_lookup is not None and semantic_cache_lookup.answer is not None:
+            response.headers["X-Cache"] = "HIT-SEMANTIC"
+            return sergeant.get_cached_response(semantic_cache_lookup)
+
+        response.headers["X-Context-Tokens"] = str(await sergeant.add_context_within_deadline(messages))
+
+        #   The key is computed after retrieval, so that a cached response is never served with a stale context
+        response_cache_ttl: Optional[float] = sergeant.llm_config.response_cache_ttl
+        cache_key: Optional[str] = ResponseCache.get_key(
+            sergeant.name,
+            sergeant.parent_model_id,
+            messages,
+            request.temperature if request.temperature is not None else sergeant.llm_config.temperature,
+            request.max_tokens if request.max_tokens is not None else sergeant.llm_config.max_tokens
+        ) if response_cache_ttl is not None else None
+        if cache_key is not None:
+            cached_response: Optional[ChatCompletionResponse] = await ResponseCache.get(cache_key)
+            if cached_response is not None:
+                response.headers["X-Cache"] = "HIT"
+                return cached_response
+
+        if cache_key is not None or semantic_cache_lookup is not None:
+            response.headers["X-Cache"] = "MISS"
+
+        chat_completion_response: ChatCompletionResponse = await sergeant.ask(messages, request)
+        if cache_key is not None and response_cache_ttl is not None:
+            await ResponseCache.set(cache_key, chat_completion_response, response_cache_ttl)
+        if semantic_cache_lookup is not None:
+            choice: Dict[str, Any] = chat_completion_response.choices[0]
+            await SemanticCache.set(semantic_cache_lookup, str(choice["message"]["content"]), choice["finish_reason"])
+
+        return chat_completion_response
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/models")
-async def models() -> Dict[str, List[Dict[str, str | int]] | str]:
-    return {
-        "object": "list",
-        "data": [{"id": sergeant.name, "object": "model", "created": start_up_time, "owned_by": "N/A"} for sergeant in Sergeant.get_all()]
-    }
+async def models() -> Response:
+    return Response(content=SergeantRegistry.get_model_list_response(), media_type="application/json")
+
+
+@app.get("/metrics/database_pool", dependencies=[Depends(AuthenticateToken())])
+async def get_database_pool_statistics() -> Dict[str, int]:
+    return VectorStore.get_pool_statistics()
+
+
+@app.get("/metrics/http_client", dependencies=[Depends(AuthenticateToken())])
+async def get_http_client_statistics() -> Dict[str, int]:
+    return common.HTTPClient.get_statistics()
+
+
+@app.get("/metrics/model_registry", dependencies=[Depends(AuthenticateToken())])
+async def get_model_registry_statistics() -> Dict[str, float]:
+    return SergeantRegistry.get_statistics()
+
+
+@app.get("/metrics/response_cache", dependencies=[Depends(AuthenticateToken())])
+async def get_response_cache_statistics() -> Dict[str, int]:
+    return ResponseCache.get_statistics()
+
+
+@app.get("/metrics/semantic_cache", dependencies=[Depends(AuthenticateToken())])
+async def get_semantic_cache_statistics() -> Dict[str, int]:
+    return SemanticCache.get_statistics()
 
 
 if __name__ == "__main__":
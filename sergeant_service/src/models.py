@@ -1,3 +1,5 @@
+import json
+import os
 import time
 import uuid
 from typing import List, Optional, Dict, Any, Union
@@ -5,6 +7,9 @@ from typing import List, Optional, Dict, Any, Union
 from langchain_core.messages import BaseMessage
 from pydantic import BaseModel, Field
 
+STREAM_BATCH_MAX_DELAY: float = float(os.getenv("SERGEANT_SERVICE_STREAM_BATCH_MAX_DELAY") or 0.02)
+STREAM_BATCH_MAX_SIZE: int = int(os.getenv("SERGEANT_SERVICE_STREAM_BATCH_MAX_SIZE") or 64)
+
 
 class Message(BaseModel):
     role: str
@@ -30,5 +35,76 @@ class ChatCompletionResponse(BaseModel):
     def get(response: BaseMessage) -> "ChatCompletionResponse":
         return ChatCompletionResponse(
             model=response.response_metadata.get("model_name"),
-            choices=[{"message": {"role": "assistant", "content": response.content}}]
+            choices=[{"index": 0, "message": {"role": "assistant", "content": response.content}, "finish_reason": response.response_metadata.get("finish_reason")}]
         )
+
+
+class ChatCompletionChunkEncoder:
+    def __init__(self, model: str, batch_max_delay: float = STREAM_BATCH_MAX_DELAY, batch_max_size: int = STREAM_BATCH_MAX_SIZE) -> None:
+        self.id: str = f"chatcmpl-{uuid.uuid4().hex}"
+        self.created: int = int(time.time())
+        self.model: str = model
+        self.batch_max_delay: float = batch_max_delay
+        self.batch_max_size: int = batch_max_size
+        self._buffer: List[str] = []
+        self._buffer_size: int = 0
+        self._buffer_started_at: float = 0
+        self._is_first_chunk: bool = True
+
+        #   Everything but the delta is the same for every chunk of a completion, so it is serialised only once
+        envelope: str = json.dumps({
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": self.id}, "finish_reason": None}],
+        })
+        placeholder: str = json.dumps(self.id)
+        placeholder_position: int = envelope.rindex(placeholder)
+        self._prefix: str = f"data: {envelope[:placeholder_position]}"
+        self._suffix: str = f"{envelope[placeholder_position + len(placeholder):]}\n\n"
+
+    def encode(self, content: str) -> str:
+        return f"{self._prefix}{json.dumps(content)}{self._suffix}"
+
+    def add(self, content: str) -> Optional[str]:
+        if len(self._buffer) == 0:
+            self._buffer_started_at = time.monotonic()
+        self._buffer.append(content)
+        self._buffer_size += len(content)
+
+        #   The first token is never held back, so that batching does not delay the time to first token
+        if self._is_first_chunk or self._buffer_size >= self.batch_max_size or time.monotonic() - self._buffer_started_at >= self.batch_max_delay:
+            self._is_first_chunk = False
+            return self.flush()
+
+        return None
+
+    def get_flush_delay(self) -> Optional[float]:
+        #   Seconds until the buffered tokens are due, None when there is nothing to flush
+        if len(self._buffer) == 0:
+            return None
+
+        return max(0.0, self.batch_max_delay - (time.monotonic() - self._buffer_started_at))
+
+    def flush(self) -> Optional[str]:
+        if len(self._buffer) == 0:
+            return None
+
+        content: str = "".join(self._buffer)
+        self._buffer.clear()
+        self._buffer_size = 0
+        return self.encode(content)
+
+    def encode_final(self, finish_reason: Optional[str], usage: Optional[Dict[str, int]]) -> str:
+        final_chunk: Dict[str, Any] = {
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason or "stop"}],
+        }
+        if usage is not None:
+            final_chunk["usage"] = usage
+
+        return f"data: {json.dumps(final_chunk)}\n\n"
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from logging import Logger
+from typing import Dict, List, Optional
+
+from common import Constants
+from sergeant import Sergeant, LLMConfig
+
+logger: Logger = logging.getLogger(__name__)
+LLM_YAML_POLL_INTERVAL: float = float(os.getenv("SERGEANT_SERVICE_LLM_YAML_POLL_INTERVAL") or 5)
+
+
+class SergeantRegistry:
+    _sergeant_dict: Dict[str, Sergeant] = {}
+    _model_list_response: bytes = b""
+    _llm_yaml_mtime: Optional[int] = None
+    _loaded_at: float = 0
+    _reload_count: int = 0
+    _reload_failure_count: int = 0
+    _lock: asyncio.Lock = asyncio.Lock()
+    _watch_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _get_llm_yaml_mtime() -> int:
+        return os.stat(Constants.LLM_YAML_PATH.value).st_mtime_ns
+
+    @staticmethod
+    def load() -> None:
+        llm_yaml_mtime: int = SergeantRegistry._get_llm_yaml_mtime()
+        llm_config_list: List[LLMConfig] = LLMConfig.get_all()
+
+        #   Unchanged models keep their chat model, so that their HTTP connections survive the reload
+        sergeant_dict: Dict[str, Sergeant] = {}
+        for llm_config in llm_config_list:
+            previous_sergeant: Optional[Sergeant] = SergeantRegistry._sergeant_dict.get(llm_config.name)
+            sergeant_dict[llm_config.name] = previous_sergeant if previous_sergeant is not None and previous_sergeant.llm_config == llm_config else Sergeant.get_from_llm_config(llm_config)
+
+        loaded_at: float = time.time()
+        model_list_response: bytes = json.dumps({
+            "object": "list",
+            "data": [{"id": name, "object": "model", "created": int(loaded_at), "owned_by": "N/A"} for name in sergeant_dict]
+        }).encode("utf-8")
+
+        #   Requests that already hold a Sergeant keep using it, new requests see the new registry as a whole
+        SergeantRegistry._sergeant_dict, SergeantRegistry._model_list_response = sergeant_dict, model_list_response
+        SergeantRegistry._llm_yaml_mtime = llm_yaml_mtime
+        SergeantRegistry._loaded_at = loaded_at
+        logger.info(f"Model registry loaded | {len(sergeant_dict)} models")
+
+    @staticmethod
+    async def reload() -> None:
+        async with SergeantRegistry._lock:
+            try:
+                await asyncio.to_thread(SergeantRegistry.load)
+                SergeantRegistry._reload_count += 1
+            except Exception as e:
+                #   An invalid llm.yml keeps the previous registry in service
+                SergeantRegistry._reload_failure_count += 1
+                logger.error(f"Model registry reload failed | {str(e)}")
+
+    @staticmethod
+    async def _watch(interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                llm_yaml_mtime: int = await asyncio.to_thread(SergeantRegistry._get_llm_yaml_mtime)
+            except OSError as e:
+                logger.warning(f"Unable to read the llm.yml modification time | {str(e)}")
+                continue
+
+            #   The modification time is recorded before reloading, so that an invalid file is only retried once it changes again
+            if llm_yaml_mtime != SergeantRegistry._llm_yaml_mtime:
+                SergeantRegistry._llm_yaml_mtime = llm_yaml_mtime
+                await SergeantRegistry.reload()
+
+    @staticmethod
+    async def start(interval: float = LLM_YAML_POLL_INTERVAL) -> None:
+        await asyncio.to_thread(SergeantRegistry.load)
+        SergeantRegistry._watch_task = asyncio.create_task(SergeantRegistry._watch(interval))
+
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(SergeantRegistry.reload()))
+        except (NotImplementedError, AttributeError, RuntimeError):
+            logger.warning("SIGHUP is not available, llm.yml is only reloaded by polling")
+
+    @staticmethod
+    async def stop() -> None:
+        try:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            pass
+
+        if SergeantRegistry._watch_task is not None:
+            SergeantRegistry._watch_task.cancel()
+            await asyncio.gather(SergeantRegistry._watch_task, return_exceptions=True)
+            SergeantRegistry._watch_task = None
+
+    @staticmethod
+    def get(model_name: str) -> Optional[Sergeant]:
+        return SergeantRegistry._sergeant_dict.get(model_name)
+
+    @staticmethod
+    def get_model_list_response() -> bytes:
+        return SergeantRegistry._model_list_response
+
+    @staticmethod
+    def get_statistics() -> Dict[str, float]:
+        return {
+            "model_count": len(SergeantRegistry._sergeant_dict),
+            "loaded_at": SergeantRegistry._loaded_at,
+            "reload_count": SergeantRegistry._reload_count,
+            "reload_failure_count": SergeantRegistry._reload_failure_count,
+        }
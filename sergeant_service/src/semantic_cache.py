@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import os
+from logging import Logger
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_postgres import PGVector
+from pydantic import BaseModel
+from sqlalchemy import text
+
+import common
+from common import Constants
+from vector_store import VectorStore, DEFAULT_EMBEDDING_MODEL
+
+logger: Logger = logging.getLogger(__name__)
+SEMANTIC_CACHE_INDEX: str = os.getenv("SERGEANT_SERVICE_SEMANTIC_CACHE_INDEX") or "sergeant_semantic_cache"
+
+
+class SemanticCacheLookup(BaseModel):
+    model: str
+    parent_model_id: str
+    query: str
+    prompt_hash: str
+    index_version: str
+    embedding: List[float]
+    answer: Optional[str] = None
+    score: Optional[float] = None
+
+
+class SemanticCache:
+    _statistics: Dict[str, int] = {
+        "hit_count": 0,
+        "miss_count": 0,
+        "skip_count": 0,
+        "error_count": 0,
+        "stored_count": 0,
+    }
+
+    @staticmethod
+    def _get_query(messages: List[Dict[str, str]]) -> Optional[Tuple[str, str]]:
+        #   Only single-turn conversations are cached, as the answer to a follow-up depends on the earlier turns
+        conversation_list: List[Dict[str, str]] = [message for message in messages if message["role"] not in ("system", "developer")]
+        if len(conversation_list) != 1 or conversation_list[0]["role"] != "user":
+            return None
+
+        prompt_list: List[str] = [message["content"] for message in messages if message["role"] in ("system", "developer")]
+        return conversation_list[0]["content"], common.get_sha256_hash("\n".join(prompt_list))
+
+    @staticmethod
+    async def _get_embedding(query: str) -> List[float]:
+        #   The vector embedding service caches embeddings, so a repeated question is only embedded once
+        async with common.HTTPClient.get_session().post(f"{Constants.VECTOR_EMBEDDING_SERVICE_URL.value}/embeddings", json={"input": query, "model": DEFAULT_EMBEDDING_MODEL}) as response:
+            response.raise_for_status()
+            return (await response.json())["data"][0]["embedding"]
+
+    @staticmethod
+    async def _get_index_version(index_list: List[str]) -> str:
+        return await VectorStore.get_index_version(index_list) if len(index_list) > 0 else ""
+
+    @staticmethod
+    async def get(model: str, parent_model_id: str, index_list: List[str], threshold: float, messages: List[Dict[str, str]]) -> Optional[SemanticCacheLookup]:
+        query: Optional[Tuple[str, str]] = SemanticCache._get_query(messages)
+        if query is None:
+            SemanticCache._statistics["skip_count"] += 1
+            return None
+
+        #   The cache is an optimisation, any failure falls back to answering the request
+        try:
+            embedding, index_version = await asyncio.gather(SemanticCache._get_embedding(query[0]), SemanticCache._get_index_version(index_list))
+            vector_store: PGVector = await VectorStore.get(SEMANTIC_CACHE_INDEX)
+            result_list: List[Tuple[Document, float]] = await vector_store.asimilarity_search_with_score_by_vector(
+                embedding,
+                k=1,
+                filter={"model": model, "parent_model_id": parent_model_id, "prompt_hash": query[1], "index_version": index_version}
+            )
+        except Exception as e:
+            SemanticCache._statistics["error_count"] += 1
+            logger.warning(f"Unable to read the semantic cache | {model} | {str(e)}")
+            return None
+
+        semantic_cache_lookup: SemanticCacheLookup = SemanticCacheLookup(model=model, parent_model_id=parent_model_id, query=query[0], prompt_hash=query[1], index_version=index_version, embedding=embedding)
+        if len(result_list) > 0 and 1 - result_list[0][1] >= threshold:
+            semantic_cache_lookup.answer = result_list[0][0].page_content
+            semantic_cache_lookup.score = 1 - result_list[0][1]
+            SemanticCache._statistics["hit_count"] += 1
+            logger.info(f"Semantic cache hit | {model} | {semantic_cache_lookup.score:.3f}")
+        else:
+            SemanticCache._statistics["miss_count"] += 1
+
+        return semantic_cache_lookup
+
+    @staticmethod
+    async def set(semantic_cache_lookup: SemanticCacheLookup, answer: str, finish_reason: Optional[str]) -> None:
+        #   Truncated or filtered answers are not worth repeating to the next user
+        if finish_reason != "stop" or answer == "":
+            return
+
+        try:
+            vector_store: PGVector = await VectorStore.get(SEMANTIC_CACHE_INDEX)
+            await vector_store.aadd_embeddings(
+                texts=[answer],
+                embeddings=[semantic_cache_lookup.embedding],
+                metadatas=[{"model": semantic_cache_lookup.model, "parent_model_id": semantic_cache_lookup.parent_model_id, "prompt_hash": semantic_cache_lookup.prompt_hash, "index_version": semantic_cache_lookup.index_version, "query": semantic_cache_lookup.query}],
+                ids=[common.get_sha256_hash(f"{semantic_cache_lookup.model}#{semantic_cache_lookup.parent_model_id}#{semantic_cache_lookup.prompt_hash}#{semantic_cache_lookup.query}")]
+            )
+
+            #   Answers given with an older version of the indexes or by another parent model can no longer be looked up, so they are removed
+            async with VectorStore.get_engine().begin() as connection:
+                await connection.execute(
+                    text("DELETE FROM langchain_pg_embedding WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :name) "
+                         "AND cmetadata->>'model' = :model "
+                         "AND (cmetadata->>'index_version' <> :index_version OR cmetadata->>'parent_model_id' IS DISTINCT FROM :parent_model_id)"),
+                    {"name": SEMANTIC_CACHE_INDEX, "model": semantic_cache_lookup.model, "index_version": semantic_cache_lookup.index_version, "parent_model_id": semantic_cache_lookup.parent_model_id}
+                )
+            SemanticCache._statistics["stored_count"] += 1
+        except Exception as e:
+            SemanticCache._statistics["error_count"] += 1
+            logger.warning(f"Unable to write the semantic cache | {semantic_cache_lookup.model} | {str(e)}")
+
+    @staticmethod
+    def get_statistics() -> Dict[str, int]:
+        return dict(SemanticCache._statistics)
@@ -1,44 +1,124 @@
-import json
+import asyncio
+import functools
+import logging
 import os
-import time
-import uuid
-from functools import lru_cache
-from typing import List, Dict, Any, Optional, AsyncGenerator
+from enum import Enum
+from itertools import zip_longest
+from logging import Logger
+from typing import List, Dict, Any, Optional, AsyncGenerator, Tuple, Callable, Awaitable, Set
 
 import yaml
-from langchain.retrievers import SelfQueryRetriever, MergerRetriever
+from langchain.retrievers import SelfQueryRetriever
 from langchain_core.documents import Document
-from langchain_core.language_models import BaseChatModel
-from langchain_core.messages import BaseMessage
-from langchain_openai import OpenAIEmbeddings
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.messages import BaseMessage, AIMessage, AIMessageChunk
+from langchain_core.runnables import Runnable
 from langchain_openai.chat_models.base import ChatOpenAI
 from langchain_postgres import PGVector
 from pydantic import BaseModel
 from starlette.responses import StreamingResponse
 
 from common import Constants
-from models import ChatCompletionRequest, ChatCompletionResponse
-
-DEFAULT_EMBEDDING_MODEL: str = os.getenv("VECTOR_EMBEDDING_SERVICE_DEFAULT_MODEL") or "text-embedding-3-small"
-
-
-async def stream_response(llm: BaseChatModel, messages: List[Dict], request: ChatCompletionRequest) -> AsyncGenerator[str, None]:
-    async for chunk in llm.astream(messages):
-        token = chunk.content
-        if token:
-            yield f"data: {json.dumps({
-                'id': str(uuid.uuid4()),
-                'object': 'chat.completion.chunk',
-                'created': int(time.time()),
-                'model': request.model,
-                'choices': [{'delta': {'content': token}}],
-            })}\n\n"
+from context import RetrievedContext, DEFAULT_CONTEXT_TOKEN_BUDGET
+from models import ChatCompletionRequest, ChatCompletionResponse, ChatCompletionChunkEncoder
+from semantic_cache import SemanticCache, SemanticCacheLookup
+from vector_store import VectorStore
+
+logger: Logger = logging.getLogger(__name__)
+DEFAULT_RETRIEVAL_TIMEOUT: float = float(os.getenv("SERGEANT_SERVICE_RETRIEVAL_TIMEOUT") or 10)
+DEFAULT_RETRIEVAL_DEADLINE: float = float(os.getenv("SERGEANT_SERVICE_RETRIEVAL_DEADLINE") or 10)
+SSE_KEEP_ALIVE_INTERVAL: float = float(os.getenv("SERGEANT_SERVICE_SSE_KEEP_ALIVE_INTERVAL") or 1)
+_background_task_set: Set[asyncio.Task] = set()
+
+
+def _run_in_background(coroutine: Awaitable[None]) -> None:
+    #   The event loop only keeps a weak reference to a task, so it is held until done
+    task: asyncio.Task = asyncio.ensure_future(coroutine)
+    _background_task_set.add(task)
+    task.add_done_callback(_background_task_set.discard)
+
+
+async def _put_chunks(llm: Runnable[LanguageModelInput, BaseMessage], messages: List[Dict], chunk_queue: asyncio.Queue) -> None:
+    #   None marks the end of the stream, an exception is handed over to be raised by the reader
+    try:
+        async for chunk in llm.astream(messages):
+            chunk_queue.put_nowait(chunk)
+        chunk_queue.put_nowait(None)
+    except Exception as e:
+        chunk_queue.put_nowait(e)
+
+
+async def stream_response(llm: Runnable[LanguageModelInput, BaseMessage], messages: List[Dict], request: ChatCompletionRequest,
+                          on_complete: Optional[Callable[[str, Optional[str]], Awaitable[None]]] = None) -> AsyncGenerator[str, None]:
+    encoder: ChatCompletionChunkEncoder = ChatCompletionChunkEncoder(request.model)
+    finish_reason: Optional[str] = None
+    usage: Optional[Dict[str, int]] = None
+    content_list: List[str] = []
+    data: Optional[str] = None
+
+    #   The model is read by a separate task, so that the buffered tokens are flushed on time even when the model stalls
+    chunk_queue: asyncio.Queue[BaseMessage | Exception | None] = asyncio.Queue()
+    put_chunks_task: asyncio.Task = asyncio.create_task(_put_chunks(llm, messages, chunk_queue))
+    try:
+        while True:
+            try:
+                chunk: BaseMessage | Exception | None = await asyncio.wait_for(chunk_queue.get(), encoder.get_flush_delay())
+            except TimeoutError:
+                data = encoder.flush()
+                if data is not None:
+                    yield data
+                continue
+
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            finish_reason = chunk.response_metadata.get("finish_reason") or finish_reason
+            if isinstance(chunk, AIMessageChunk) and chunk.usage_metadata is not None:
+                usage = {
+                    "prompt_tokens": chunk.usage_metadata["input_tokens"],
+                    "completion_tokens": chunk.usage_metadata["output_tokens"],
+                    "total_tokens": chunk.usage_metadata["total_tokens"],
+                }
+
+            if chunk.content and isinstance(chunk.content, str):
+                if on_complete is not None:
+                    content_list.append(chunk.content)
+                data = encoder.add(chunk.content)
+                if data is not None:
+                    yield data
+    finally:
+        put_chunks_task.cancel()
+
+    #   Clients close the connection once they read [DONE], so the completion is handed over before it is sent
+    if on_complete is not None:
+        _run_in_background(on_complete("".join(content_list), finish_reason))
+
+    data = encoder.flush()
+    if data is not None:
+        yield data
+    yield encoder.encode_final(finish_reason, usage)
+    yield "data: [DONE]\n\n"
+
+
+async def stream_cached_response(content: str, request: ChatCompletionRequest) -> AsyncGenerator[str, None]:
+    encoder: ChatCompletionChunkEncoder = ChatCompletionChunkEncoder(request.model)
+    yield encoder.encode(content)
+    yield encoder.encode_final("stop", None)
     yield "data: [DONE]\n\n"
 
 
+class RetrievalMode(str, Enum):
+    DIRECT = "direct"
+    SELF_QUERY = "self_query"
+    DIRECT_AND_SELF_QUERY = "direct_and_self_query"
+
+
 class LLMIndexConfig(BaseModel):
     id: str
     description: str
+    timeout: Optional[float] = None
 
 
 class LLMConfig(BaseModel):
@@ -49,6 +129,12 @@ class LLMConfig(BaseModel):
     max_tokens: Optional[int] = None
     developer_prompt: str = "You are a helpful assistant."
     index_list: List[LLMIndexConfig] = []
+    retrieval_mode: RetrievalMode = RetrievalMode.SELF_QUERY
+    retrieval_timeout: float = DEFAULT_RETRIEVAL_TIMEOUT
+    retrieval_deadline: float = DEFAULT_RETRIEVAL_DEADLINE
+    context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET
+    response_cache_ttl: Optional[float] = None
+    semantic_cache_threshold: Optional[float] = None
     api_key: Optional[str] = None
 
     @staticmethod
@@ -65,6 +151,12 @@ class LLMConfig(BaseModel):
             max_tokens: int = raw_data.get("max_tokens")
             developer_prompt: str = raw_data.get("developer_prompt") or "You are a helpful assistant."
             index_list: List[LLMIndexConfig] = [LLMIndexConfig(**index_config) for index_config in raw_data.get("indexes")] if raw_data.get("indexes") is not None else []
+            retrieval_mode: RetrievalMode = RetrievalMode(raw_data.get("retrieval_mode") or RetrievalMode.SELF_QUERY)
+            retrieval_timeout: float = raw_data.get("retrieval_timeout") or DEFAULT_RETRIEVAL_TIMEOUT
+            retrieval_deadline: float = raw_data.get("retrieval_deadline") or DEFAULT_RETRIEVAL_DEADLINE
+            context_token_budget: int = raw_data.get("context_token_budget") or DEFAULT_CONTEXT_TOKEN_BUDGET
+            response_cache_ttl: Optional[float] = raw_data.get("response_cache_ttl")
+            semantic_cache_threshold: Optional[float] = raw_data.get("semantic_cache_threshold")
 
             if raw_data.get("api_key") is not None:
                 api_key: str = raw_data.get("api_key")
@@ -81,6 +173,12 @@ class LLMConfig(BaseModel):
                 max_tokens=max_tokens,
                 developer_prompt=developer_prompt,
                 index_list=index_list,
+                retrieval_mode=retrieval_mode,
+                retrieval_timeout=retrieval_timeout,
+                retrieval_deadline=retrieval_deadline,
+                context_token_budget=context_token_budget,
+                response_cache_ttl=response_cache_ttl,
+                semantic_cache_threshold=semantic_cache_threshold,
                 api_key=api_key
             ))
 
@@ -94,39 +192,144 @@ class Sergeant(BaseModel):
     model: ChatOpenAI
     llm_config: LLMConfig
 
-    def add_context_from_indexes(self, messages: List[Dict[str, str]]) -> None:
-        retrievers_list: List[SelfQueryRetriever] = []
+    async def _get_documents_from_index(self, index: LLMIndexConfig, query: str, query_embedding_task: Optional[asyncio.Task]) -> List[Document]:
+        vector_store: PGVector = await VectorStore.get(index.id)
+        document_list_list: List[List[Document]] = []
 
-        for index in self.llm_config.index_list:
-            vector_store = PGVector(
-                embeddings=OpenAIEmbeddings(model=DEFAULT_EMBEDDING_MODEL),
-                collection_name=index.id,
-                connection=os.getenv("VECTOR_EMBEDDING_SERVICE_DATABASE_URL"),
-                use_jsonb=True,
-            )
+        if query_embedding_task is not None:
+            query_embedding: List[float] = await asyncio.shield(query_embedding_task)
+            document_score_list: List[Tuple[Document, float]] = await vector_store.asimilarity_search_with_score_by_vector(query_embedding)
+            for document, score in document_score_list:
+                #   PGVector returns the cosine distance, the score kept with the document is the similarity
+                document.metadata["score"] = 1 - score
+            document_list_list.append([document for document, _ in document_score_list])
+
+        if self.llm_config.retrieval_mode in (RetrievalMode.SELF_QUERY, RetrievalMode.DIRECT_AND_SELF_QUERY):
             retriever: SelfQueryRetriever = SelfQueryRetriever.from_llm(self.model, vector_store, index.description, metadata_field_info=[], verbose=True)
-            retrievers_list.append(retriever)
+            document_list_list.append(await retriever.ainvoke(query))
+
+        document_dict: Dict[str, Document] = {}
+        for document_tuple in zip_longest(*document_list_list):
+            for document in document_tuple:
+                if document is not None:
+                    document_dict.setdefault(document.id or document.page_content, document)
 
-        parent_retriever: MergerRetriever = MergerRetriever(retrievers=retrievers_list)  # type: ignore[arg-type]
+        return list(document_dict.values())
 
+    async def add_context_from_indexes(self, messages: List[Dict[str, str]]) -> int:
         query: str = messages[-1]["content"]
-        retrieved_docs: List[Document] = parent_retriever.invoke(query)
-        if len(retrieved_docs) > 0:
-            context: str = ""
-            for document in retrieved_docs:
-                context = context + "# Data\n"
-                context = context + f"{document.page_content}"
-                context = context + "# Metadata\n"
-                context = context + f"## Source\nf{document.metadata.get("source")}"
-
-            messages.insert(0, {"role": "system", "content": f"{self.developer_prompt}\n---\n# Context retrieved\n{context}"})
-
-    async def ask(self, messages: List[Dict[str, str]]) -> ChatCompletionResponse:
-        response: BaseMessage = await self.model.ainvoke(messages)
+        query_embedding_task: Optional[asyncio.Task] = None
+        if self.llm_config.retrieval_mode in (RetrievalMode.DIRECT, RetrievalMode.DIRECT_AND_SELF_QUERY):
+            #   The query is embedded once and the vector is shared by every index of the model
+            query_embedding_task = asyncio.create_task(VectorStore.get_embeddings().aembed_query(query))
+
+        result_list: List[List[Document] | BaseException] = await asyncio.gather(*[
+            asyncio.wait_for(self._get_documents_from_index(index, query, query_embedding_task), index.timeout or self.llm_config.retrieval_timeout)
+            for index in self.llm_config.index_list
+        ], return_exceptions=True)
+
+        if query_embedding_task is not None and not query_embedding_task.done():
+            query_embedding_task.cancel()
+
+        document_list_list: List[List[Document]] = []
+        for index, result in zip(self.llm_config.index_list, result_list):
+            if isinstance(result, BaseException):
+                logger.warning(f"Dropping the index from the context | {index.id} | {type(result).__name__}: {result}")
+                continue
+            document_list_list.append(result)
+
+        #   Interleaves the documents of every index by rank, the same way MergerRetriever does
+        retrieved_docs: List[Document] = [document for document_tuple in zip_longest(*document_list_list) for document in document_tuple if document is not None]
+        retrieved_context: RetrievedContext = RetrievedContext.get(retrieved_docs, self.llm_config.context_token_budget, self.parent_model_id)
+        logger.info(f"Context retrieved | {self.name} | {retrieved_context.document_count} of {len(retrieved_docs)} documents | {retrieved_context.token_count} tokens")
+        if retrieved_context.document_count > 0:
+            messages.insert(0, {"role": "system", "content": f"{self.developer_prompt}\n---\n# Context retrieved\n{retrieved_context.content}"})
+
+        return retrieved_context.token_count
+
+    async def add_context_within_deadline(self, messages: List[Dict[str, str]]) -> int:
+        if len(self.llm_config.index_list) == 0:
+            return 0
+
+        try:
+            return await asyncio.wait_for(self.add_context_from_indexes(messages), self.llm_config.retrieval_deadline)
+        except TimeoutError:
+            logger.warning(f"Answering without context as the retrieval deadline was reached | {self.name} | {self.llm_config.retrieval_deadline}s")
+            return 0
+
+    async def get_semantic_cache_lookup(self, messages: List[Dict[str, str]]) -> Optional[SemanticCacheLookup]:
+        if self.llm_config.semantic_cache_threshold is None:
+            return None
+
+        try:
+            return await asyncio.wait_for(
+                SemanticCache.get(self.name, self.parent_model_id, [index.id for index in self.llm_config.index_list], self.llm_config.semantic_cache_threshold, messages),
+                self.llm_config.retrieval_deadline
+            )
+        except TimeoutError:
+            logger.warning(f"Skipping the semantic cache as the retrieval deadline was reached | {self.name} | {self.llm_config.retrieval_deadline}s")
+            return None
+
+    def get_cached_response(self, semantic_cache_lookup: SemanticCacheLookup) -> ChatCompletionResponse:
+        return ChatCompletionResponse.get(AIMessage(content=semantic_cache_lookup.answer, response_metadata={"model_name": self.parent_model_id, "finish_reason": "stop"}))
+
+    @staticmethod
+    async def _get_keep_alive_comments(task: asyncio.Task) -> AsyncGenerator[str, None]:
+        #   SSE comments keep the connection alive while the task runs, clients ignore them
+        while not task.done():
+            done_set, _ = await asyncio.wait({task}, timeout=SSE_KEEP_ALIVE_INTERVAL)
+            if len(done_set) == 0:
+                yield ": keep-alive\n\n"
+
+    async def _stream_with_context(self, messages: List[Dict[str, str]], request: ChatCompletionRequest) -> AsyncGenerator[str, None]:
+        if self.llm_config.semantic_cache_threshold is not None or len(self.llm_config.index_list) > 0:
+            yield ": retrieving context\n\n"
+
+        semantic_cache_lookup: Optional[SemanticCacheLookup] = None
+        if self.llm_config.semantic_cache_threshold is not None:
+            semantic_cache_task: asyncio.Task = asyncio.create_task(self.get_semantic_cache_lookup(messages))
+            try:
+                async for data in Sergeant._get_keep_alive_comments(semantic_cache_task):
+                    yield data
+            finally:
+                semantic_cache_task.cancel()
+
+            semantic_cache_lookup = semantic_cache_task.result()
+            if semantic_cache_lookup is not None and semantic_cache_lookup.answer is not None:
+                yield ": semantic cache hit\n\n"
+                async for data in stream_cached_response(semantic_cache_lookup.answer, request):
+                    yield data
+                return
+
+        if len(self.llm_config.index_list) > 0:
+            retrieval_task: asyncio.Task = asyncio.create_task(self.add_context_within_deadline(messages))
+            try:
+                async for data in Sergeant._get_keep_alive_comments(retrieval_task):
+                    yield data
+            finally:
+                retrieval_task.cancel()
+
+            #   The response has already started, so a failed retrieval can only be answered without context
+            try:
+                yield f": context retrieved with {retrieval_task.result()} tokens\n\n"
+            except Exception as e:
+                logger.error(f"Answering without context as the retrieval failed | {self.name} | {str(e)}")
+
+        on_complete: Optional[Callable[[str, Optional[str]], Awaitable[None]]] = functools.partial(SemanticCache.set, semantic_cache_lookup) if semantic_cache_lookup is not None else None
+        async for data in stream_response(self.get_chat_model(request), messages, request, on_complete):
+            yield data
+
+    def get_chat_model(self, request: ChatCompletionRequest) -> Runnable[LanguageModelInput, BaseMessage]:
+        #   The cached chat model is shared by concurrent requests, so the generation parameters are bound per request instead of assigned
+        generation_kwargs: Dict[str, Any] = {key: value for key, value in {"temperature": request.temperature, "max_tokens": request.max_tokens}.items() if value is not None}
+        return self.model.bind(**generation_kwargs) if len(generation_kwargs) > 0 else self.model
+
+    async def ask(self, messages: List[Dict[str, str]], request: ChatCompletionRequest) -> ChatCompletionResponse:
+        response: BaseMessage = await self.get_chat_model(request).ainvoke(messages)
         return ChatCompletionResponse.get(response)
 
     def ask_stream(self, messages: List[Dict[str, str]], request: ChatCompletionRequest) -> StreamingResponse:
-        return StreamingResponse(stream_response(self.model, messages, request), media_type="text/event-stream")
+        return StreamingResponse(self._stream_with_context(messages, request), media_type="text/event-stream")
 
     @staticmethod
     def _get_base_chat_model(llm_config: LLMConfig) -> ChatOpenAI:
@@ -135,29 +338,19 @@ class Sergeant(BaseModel):
             temperature=llm_config.temperature,
             max_tokens=llm_config.max_tokens,  # type: ignore[call-arg]
             base_url=llm_config.endpoint or os.getenv("OPENAI_COMPATIBLE_API_BASE_URL") or "https://api.openai.com/v1",
+            stream_usage=True,
             api_key=llm_config.api_key  # type: ignore[arg-type]
         )
 
     @staticmethod
-    @lru_cache
-    def get_all() -> List["Sergeant"]:
-        sergeant_list: List[Sergeant] = []
-        for llm_config in LLMConfig.get_all():
-            chat_model: ChatOpenAI = Sergeant._get_base_chat_model(llm_config)
-
-            sergeant_list.append(Sergeant(
-                name=llm_config.name,
-                parent_model_id=llm_config.parent_model_id,
-                developer_prompt=llm_config.developer_prompt,
-                model=chat_model,
-                llm_config=llm_config
-            ))
-
-        return sergeant_list
-
-    @staticmethod
-    def get(model_name: str) -> "Sergeant":
-        return next(filter(lambda s: s.name == model_name, Sergeant.get_all()))
+    def get_from_llm_config(llm_config: LLMConfig) -> "Sergeant":
+        return Sergeant(
+            name=llm_config.name,
+            parent_model_id=llm_config.parent_model_id,
+            developer_prompt=llm_config.developer_prompt,
+            model=Sergeant._get_base_chat_model(llm_config),
+            llm_config=llm_config
+        )
 
     @staticmethod
     def get_messages(request: BaseModel, sergeant: "Sergeant") -> List[Dict[str, str]]:
@@ -0,0 +1,91 @@
+import asyncio
+import os
+from typing import Dict, Tuple, Optional, List
+
+from langchain_openai import OpenAIEmbeddings
+from langchain_postgres import PGVector
+from sqlalchemy import make_url, URL, AsyncAdaptedQueuePool, Result, text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+
+DEFAULT_EMBEDDING_MODEL: str = os.getenv("VECTOR_EMBEDDING_SERVICE_DEFAULT_MODEL") or "text-embedding-3-small"
+POOL_SIZE: int = int(os.getenv("DATABASE_POOL_SIZE") or 5)
+POOL_MAX_OVERFLOW: int = int(os.getenv("DATABASE_POOL_MAX_OVERFLOW") or 10)
+
+
+class VectorStore:
+    _engine: Optional[AsyncEngine] = None
+    _embeddings_dict: Dict[str, OpenAIEmbeddings] = {}
+    _vector_store_dict: Dict[Tuple[str, str], PGVector] = {}
+    _lock: asyncio.Lock = asyncio.Lock()
+
+    @staticmethod
+    def get_engine() -> AsyncEngine:
+        if VectorStore._engine is None:
+            #   psycopg (v3) is used as asyncpg cannot run the multi-statement vector extension check in langchain_postgres
+            url: URL = make_url(os.getenv("VECTOR_EMBEDDING_SERVICE_DATABASE_URL")).set(drivername="postgresql+psycopg")
+            VectorStore._engine = create_async_engine(
+                url,
+                pool_size=POOL_SIZE,
+                max_overflow=POOL_MAX_OVERFLOW,
+                pool_pre_ping=True,
+            )
+
+        return VectorStore._engine
+
+    @staticmethod
+    def get_embeddings(model: Optional[str] = None) -> OpenAIEmbeddings:
+        model = DEFAULT_EMBEDDING_MODEL if model is None else model
+        if model not in VectorStore._embeddings_dict:
+            VectorStore._embeddings_dict[model] = OpenAIEmbeddings(model=model)
+
+        return VectorStore._embeddings_dict[model]
+
+    @staticmethod
+    async def get(index: str, model: Optional[str] = None) -> PGVector:
+        model = DEFAULT_EMBEDDING_MODEL if model is None else model
+        key: Tuple[str, str] = (index, model)
+        if key in VectorStore._vector_store_dict:
+            return VectorStore._vector_store_dict[key]
+
+        async with VectorStore._lock:
+            if key not in VectorStore._vector_store_dict:
+                vector_store: PGVector = PGVector(
+                    embeddings=VectorStore.get_embeddings(model),
+                    collection_name=index,
+                    connection=VectorStore.get_engine(),
+                    use_jsonb=True,
+                )
+                await vector_store.acreate_collection()
+                VectorStore._vector_store_dict[key] = vector_store
+
+        return VectorStore._vector_store_dict[key]
+
+    @staticmethod
+    async def get_index_version(index_list: List[str]) -> str:
+        #   The vector embedding service increments the version of a collection on every write to it
+        async with VectorStore.get_engine().connect() as connection:
+            result: Result = await connection.execute(
+                text("SELECT name, cmetadata->>'version' AS version FROM langchain_pg_collection WHERE name = ANY(:name_list)"),
+                {"name_list": index_list}
+            )
+            version_dict: Dict[str, str] = {row.name: row.version for row in result.all()}
+
+        return ",".join(f"{index}:{version_dict.get(index) or 0}" for index in sorted(index_list))
+
+    @staticmethod
+    def get_pool_statistics() -> Dict[str, int]:
+        pool: AsyncAdaptedQueuePool = VectorStore.get_engine().pool  # type: ignore[assignment]
+        return {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "vector_store_count": len(VectorStore._vector_store_dict),
+        }
+
+    @staticmethod
+    async def close() -> None:
+        if VectorStore._engine is not None:
+            await VectorStore._engine.dispose()
+            VectorStore._engine = None
+            VectorStore._vector_store_dict.clear()
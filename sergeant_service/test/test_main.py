@@ -1,9 +1,20 @@
-from typing import List, Dict, Any
+import base64
+import json
+import time
+import uuid
+import asyncio
+from typing import List, Dict, Any, Tuple, AsyncIterator
 import aiohttp
 import pytest
-from src.models import Message, ChatCompletionRequest
+from langchain_core.messages import AIMessageChunk
+from src import common
+from src.models import Message, ChatCompletionRequest, ChatCompletionChunkEncoder
+from src.sergeant import stream_response
 
 BASE_URL: str = "http://0.0.0.0:8000"
+BENCHMARK_TOKEN_COUNT: int = 100000
+LOAD_TEST_CONCURRENCY: int = 16
+STREAM_STALL_SECONDS: float = 2
 
 
 @pytest.mark.asyncio
@@ -48,6 +59,55 @@ async def test_chat_completion_with_index() -> None:
             assert response.status == 200
 
 
+@pytest.mark.asyncio
+async def test_chat_completion_stream_with_index() -> None:
+    mock_message_list: List[Message] = [Message(role="user", content="What is the capital of France? Answer in one word only.")]
+    mock_chat_completion_request: ChatCompletionRequest = ChatCompletionRequest(
+        model="Notes",
+        messages=mock_message_list,
+        max_tokens=100,
+        temperature=0.7,
+        stream=True
+    )
+    url: str = f"{BASE_URL}/chat/completions"
+    json: Dict[Any, Any] = mock_chat_completion_request.model_dump()
+
+    async with aiohttp.ClientSession() as session:
+        start_time: float = time.perf_counter()
+        async with session.post(url, json=json) as response:
+            assert response.status == 200
+            first_line: bytes = await response.content.readline()
+            time_to_first_byte: float = time.perf_counter() - start_time
+            body: str = first_line.decode() + (await response.read()).decode()
+            print(f"Time to first byte: {time_to_first_byte:.3f}s")
+            assert first_line.startswith(b":")
+            assert body.rstrip().endswith("data: [DONE]")
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_concurrent_generation_parameters() -> None:
+    #   Requests capped at one token must stop on length, the others must not inherit that cap from a concurrent request
+    async def post(session: aiohttp.ClientSession, temperature: float, max_tokens: int) -> Tuple[int, Dict[str, Any]]:
+        mock_chat_completion_request: ChatCompletionRequest = ChatCompletionRequest(
+            model="GPT-4o Mini",
+            messages=[Message(role="user", content="Count from 1 to 10, separated by commas.")],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=False
+        )
+        async with session.post(f"{BASE_URL}/chat/completions", json=mock_chat_completion_request.model_dump()) as response:
+            return max_tokens, await response.json()
+
+    async with aiohttp.ClientSession() as session:
+        result_list: List[Tuple[int, Dict[str, Any]]] = await asyncio.gather(*[
+            post(session, temperature=(i % 5) * 0.4, max_tokens=1 if i % 2 == 0 else 200) for i in range(LOAD_TEST_CONCURRENCY)
+        ])
+
+    for max_tokens, data in result_list:
+        finish_reason: str = data["choices"][0]["finish_reason"]
+        assert (finish_reason == "length") == (max_tokens == 1)
+
+
 @pytest.mark.asyncio
 async def test_all_models() -> None:
     url: str = f"{BASE_URL}/models"
@@ -57,3 +117,174 @@ async def test_all_models() -> None:
             data = await response.json()
             print(data)
             assert len(data["data"]) > 0
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_response_cache() -> None:
+    mock_chat_completion_request: ChatCompletionRequest = ChatCompletionRequest(
+        model="Notes",
+        messages=[Message(role="user", content=f"Repeat this identifier exactly: {uuid.uuid4()}")],
+        max_tokens=100,
+        temperature=0,
+        stream=False
+    )
+    url: str = f"{BASE_URL}/chat/completions"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=mock_chat_completion_request.model_dump()) as response:
+            assert response.status == 200
+            assert response.headers["X-Cache"] == "MISS"
+            first_data: Dict[str, Any] = await response.json()
+
+        async with session.post(url, json=mock_chat_completion_request.model_dump()) as response:
+            assert response.status == 200
+            assert response.headers["X-Cache"] == "HIT"
+            assert await response.json() == first_data
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_semantic_cache() -> None:
+    mock_chat_completion_request: ChatCompletionRequest = ChatCompletionRequest(
+        model="Lieutenant's Code",
+        messages=[Message(role="user", content=f"Which service stores the embeddings? Reference: {uuid.uuid4()}")],
+        max_tokens=200,
+        stream=False
+    )
+    url: str = f"{BASE_URL}/chat/completions"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=mock_chat_completion_request.model_dump()) as response:
+            assert response.status == 200
+            assert response.headers["X-Cache"] == "MISS"
+            first_data: Dict[str, Any] = await response.json()
+
+        async with session.post(url, json=mock_chat_completion_request.model_dump() | {"stream": True}) as response:
+            assert response.status == 200
+            body: str = (await response.read()).decode()
+            assert ": semantic cache hit" in body
+            assert json.dumps(first_data["choices"][0]["message"]["content"]) in body
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_stream_semantic_cache() -> None:
+    mock_chat_completion_request: ChatCompletionRequest = ChatCompletionRequest(
+        model="Lieutenant's Code",
+        messages=[Message(role="user", content=f"Which service stores the embeddings? Reference: {uuid.uuid4()}")],
+        max_tokens=200,
+        stream=True
+    )
+    url: str = f"{BASE_URL}/chat/completions"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{BASE_URL}/metrics/semantic_cache") as response:
+            stored_count: int = (await response.json())["stored_count"]
+
+        #   The connection is closed as soon as [DONE] is read, the way OpenAI-compatible clients do
+        async with session.post(url, json=mock_chat_completion_request.model_dump()) as response:
+            assert response.status == 200
+            assert (await response.content.readline()).startswith(b": retrieving context")
+            async for line in response.content:
+                if line.startswith(b"data: [DONE]"):
+                    break
+
+        for _ in range(10):
+            await asyncio.sleep(1)
+            async with session.get(f"{BASE_URL}/metrics/semantic_cache") as response:
+                data: Dict[str, int] = await response.json()
+            if data["stored_count"] > stored_count:
+                break
+
+        print(data)
+        assert data["stored_count"] > stored_count
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_unknown_model() -> None:
+    mock_chat_completion_request: ChatCompletionRequest = ChatCompletionRequest(
+        model=f"Unknown Model {uuid.uuid4()}",
+        messages=[Message(role="user", content="What is the capital of France? Answer in one word only.")],
+        stream=False
+    )
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{BASE_URL}/chat/completions", json=mock_chat_completion_request.model_dump()) as response:
+            assert response.status == 404
+
+        async with session.get(f"{BASE_URL}/metrics/model_registry") as response:
+            data = await response.json()
+            print(data)
+            assert data["model_count"] > 0
+
+
+def test_stream_encoder_benchmark() -> None:
+    token_list: List[str] = [f" token{i % 100}\"" for i in range(BENCHMARK_TOKEN_COUNT)]
+
+    start_time: float = time.perf_counter()
+    for token in token_list:
+        f"data: {json.dumps({'id': str(uuid.uuid4()), 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': 'GPT-4o', 'choices': [{'delta': {'content': token}}]})}\n\n"
+    baseline_chunks_per_second: float = BENCHMARK_TOKEN_COUNT / (time.perf_counter() - start_time)
+
+    encoder: ChatCompletionChunkEncoder = ChatCompletionChunkEncoder("GPT-4o", batch_max_delay=0, batch_max_size=0)
+    start_time = time.perf_counter()
+    data_list: List[str] = [encoder.encode(token) for token in token_list]
+    encoder_chunks_per_second: float = BENCHMARK_TOKEN_COUNT / (time.perf_counter() - start_time)
+
+    print(f"Chunks per second | Baseline: {baseline_chunks_per_second:.0f} | Encoder: {encoder_chunks_per_second:.0f}")
+    assert encoder_chunks_per_second > baseline_chunks_per_second
+    assert json.loads(data_list[-1].removeprefix("data: "))["choices"][0]["delta"]["content"] == token_list[-1]
+    assert len({json.loads(data.removeprefix("data: "))["id"] for data in data_list[:100]}) == 1
+
+
+class StallingChatModel:
+    async def astream(self, messages: List[Dict]) -> AsyncIterator[AIMessageChunk]:
+        yield AIMessageChunk(content="Hello")
+        yield AIMessageChunk(content=",")
+        await asyncio.sleep(STREAM_STALL_SECONDS)
+        yield AIMessageChunk(content=" world", response_metadata={"finish_reason": "stop"})
+
+
+@pytest.mark.asyncio
+async def test_stream_response_flushes_during_stall() -> None:
+    mock_chat_completion_request: ChatCompletionRequest = ChatCompletionRequest(model="GPT-4o (OpenAI)", messages=[Message(role="user", content="Hello")], stream=True)
+
+    start_time: float = time.perf_counter()
+    content_list: List[Tuple[float, str]] = []
+    async for data in stream_response(StallingChatModel(), [], mock_chat_completion_request):  # type: ignore[arg-type]
+        if data.startswith("data: {"):
+            delta: Dict[str, Any] = json.loads(data.removeprefix("data: "))["choices"][0]["delta"]
+            if "content" in delta:
+                content_list.append((time.perf_counter() - start_time, delta["content"]))
+
+    print(content_list)
+    assert "".join(content for _, content in content_list) == "Hello, world"
+    assert content_list[0][1] == "Hello"
+    assert all(elapsed < STREAM_STALL_SECONDS / 2 for elapsed, content in content_list if content != " world")
+
+
+def _get_jwt_segment(data: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).rstrip(b"=").decode("utf-8")
+
+
+@pytest.mark.asyncio
+async def test_is_valid_jwt_token_rejects_malformed_and_expired_tokens(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(common, "JWT_SECRET", None)
+    header_segment: str = _get_jwt_segment({"alg": "HS256", "typ": "JWT"})
+
+    assert not await common.is_valid_jwt_token("a.MQ.b")
+    assert not await common.is_valid_jwt_token("a.eyJleHAiOiJ4In0.b")
+    assert not await common.is_valid_jwt_token(f"{header_segment}.{_get_jwt_segment({'exp': time.time() - 60})}.b")
+
+    monkeypatch.setattr(common, "JWT_SECRET", "secret")
+    assert not await common.is_valid_jwt_token(f"MQ.{_get_jwt_segment({'exp': time.time() + 60})}.b")
+
+
+@pytest.mark.asyncio
+async def test_is_valid_jwt_token_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(common, "JWT_SECRET", None)
+    jwt_token_list: List[str] = [f"cached-token-{uuid.uuid4()}", f"cached-token-{uuid.uuid4()}"]
+    for jwt_token in jwt_token_list:
+        common._jwt_validation_cache[common.get_sha256_hash(jwt_token)] = (True, time.time() + 60)
+
+    #   A cached token is answered without Open WebUI and becomes the most recently used entry
+    assert await common.is_valid_jwt_token(jwt_token_list[0])
+    assert next(reversed(common._jwt_validation_cache)) == common.get_sha256_hash(jwt_token_list[0])
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import common
+
+EMBEDDING_CACHE_MAX_SIZE: int = int(os.getenv("VECTOR_EMBEDDING_SERVICE_EMBEDDING_CACHE_MAX_SIZE") or 10000)
+EMBEDDING_CACHE_PATH: Optional[str] = os.getenv("VECTOR_EMBEDDING_SERVICE_EMBEDDING_CACHE_PATH")
+
+
+class EmbeddingCache:
+    _memory_cache: OrderedDict[Tuple[str, str], List[float]] = OrderedDict()
+    _connection: Optional[sqlite3.Connection] = None
+    _connection_lock: threading.Lock = threading.Lock()
+    _statistics: Dict[str, int] = {
+        "memory_hit_count": 0,
+        "disk_hit_count": 0,
+        "miss_count": 0,
+        "bypass_count": 0,
+    }
+
+    @staticmethod
+    def _get_key(text: str, model: str) -> Tuple[str, str]:
+        #   Whitespace differences do not change the meaning of a query, so they share a cache entry
+        return model, common.get_sha256_hash(" ".join(text.split()))
+
+    @staticmethod
+    def _get_connection() -> Optional[sqlite3.Connection]:
+        if EMBEDDING_CACHE_PATH is None:
+            return None
+
+        if EmbeddingCache._connection is None:
+            EmbeddingCache._connection = sqlite3.connect(EMBEDDING_CACHE_PATH, check_same_thread=False)
+            EmbeddingCache._connection.execute("CREATE TABLE IF NOT EXISTS embedding_cache (model TEXT NOT NULL, text_hash TEXT NOT NULL, embedding TEXT NOT NULL, PRIMARY KEY (model, text_hash))")
+            EmbeddingCache._connection.commit()
+
+        return EmbeddingCache._connection
+
+    @staticmethod
+    def _get_from_disk(key: Tuple[str, str]) -> Optional[List[float]]:
+        with EmbeddingCache._connection_lock:
+            connection: Optional[sqlite3.Connection] = EmbeddingCache._get_connection()
+            if connection is None:
+                return None
+            row: Optional[Tuple[str]] = connection.execute("SELECT embedding FROM embedding_cache WHERE model = ? AND text_hash = ?", key).fetchone()
+
+        return json.loads(row[0]) if row is not None else None
+
+    @staticmethod
+    def _set_to_disk(key: Tuple[str, str], embedding: List[float]) -> None:
+        with EmbeddingCache._connection_lock:
+            connection: Optional[sqlite3.Connection] = EmbeddingCache._get_connection()
+            if connection is None:
+                return
+            connection.execute("INSERT OR REPLACE INTO embedding_cache (model, text_hash, embedding) VALUES (?, ?, ?)", (*key, json.dumps(embedding)))
+            connection.commit()
+
+    @staticmethod
+    def _set_to_memory(key: Tuple[str, str], embedding: List[float]) -> None:
+        EmbeddingCache._memory_cache[key] = embedding
+        EmbeddingCache._memory_cache.move_to_end(key)
+        while len(EmbeddingCache._memory_cache) > EMBEDDING_CACHE_MAX_SIZE:
+            EmbeddingCache._memory_cache.popitem(last=False)
+
+    @staticmethod
+    async def get(text: str, model: str) -> Optional[List[float]]:
+        key: Tuple[str, str] = EmbeddingCache._get_key(text, model)
+        embedding: Optional[List[float]] = EmbeddingCache._memory_cache.get(key)
+        if embedding is not None:
+            EmbeddingCache._memory_cache.move_to_end(key)
+            EmbeddingCache._statistics["memory_hit_count"] += 1
+            return embedding
+
+        embedding = await asyncio.to_thread(EmbeddingCache._get_from_disk, key)
+        if embedding is not None:
+            EmbeddingCache._set_to_memory(key, embedding)
+            EmbeddingCache._statistics["disk_hit_count"] += 1
+            return embedding
+
+        EmbeddingCache._statistics["miss_count"] += 1
+        return None
+
+    @staticmethod
+    async def set(text: str, model: str, embedding: List[float]) -> None:
+        key: Tuple[str, str] = EmbeddingCache._get_key(text, model)
+        EmbeddingCache._set_to_memory(key, embedding)
+        await asyncio.to_thread(EmbeddingCache._set_to_disk, key, embedding)
+
+    @staticmethod
+    def add_bypass() -> None:
+        EmbeddingCache._statistics["bypass_count"] += 1
+
+    @staticmethod
+    def get_statistics() -> Dict[str, int]:
+        return EmbeddingCache._statistics | {"memory_size": len(EmbeddingCache._memory_cache)}
+
+    @staticmethod
+    def close() -> None:
+        with EmbeddingCache._connection_lock:
+            if EmbeddingCache._connection is not None:
+                EmbeddingCache._connection.close()
+                EmbeddingCache._connection = None
@@ -1,6 +1,7 @@
 import logging
 import os
-from typing import Dict, Any, List
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, AsyncGenerator
 
 import sentry_sdk
 from fastapi import FastAPI, Depends, Body
@@ -9,7 +10,10 @@ from starlette.exceptions import HTTPException
 from starlette.requests import Request
 
 import common
-from models import EmbeddingQuery, Embedding
+from embedding_cache import EmbeddingCache
+from models import EmbeddingQuery, Embedding, EmbeddingBatch, EmbeddingUpsertResult, UpsertStatus, EmbeddingSearchPage, EmbeddingDelete
+from vector_index import VectorIndex, VectorIndexStatus
+from vector_store import VectorStore
 
 if os.getenv("SENTRY_DSN"):
     sentry_sdk.init(
@@ -17,11 +21,21 @@ if os.getenv("SENTRY_DSN"):
         traces_sample_rate=1.0,
         _experiments={"continuous_profiling_auto_start": True, },
     )
-app = FastAPI(title="Vector Embedding Service API")
 logging.basicConfig(level=logging.DEBUG if common.is_test_environment() else logging.INFO,
                     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncGenerator:
+    yield
+    await VectorStore.close()
+    await common.HTTPClient.close()
+    EmbeddingCache.close()
+
+
+app = FastAPI(title="Vector Embedding Service API", lifespan=lifespan)
+
+
 class AuthenticateToken(HTTPBearer):
     def __init__(self, auto_error: bool = True):
         super(AuthenticateToken, self).__init__(auto_error=auto_error)
@@ -36,18 +50,85 @@ class AuthenticateToken(HTTPBearer):
 
 
 @app.post("/database", dependencies=[Depends(AuthenticateToken())])
-async def upsert_embedding(embedding: Embedding) -> None:
-    embedding.upsert()
+async def upsert_embedding(embedding: Embedding) -> EmbeddingUpsertResult:
+    result: EmbeddingUpsertResult = await embedding.upsert()
+    if result.status == UpsertStatus.FAILED:
+        raise HTTPException(status_code=500, detail=result.detail)
+
+    return result
+
+
+@app.post("/database/batch", dependencies=[Depends(AuthenticateToken())])
+async def upsert_embedding_batch(request: Request) -> List[EmbeddingUpsertResult]:
+    embedding_batch: EmbeddingBatch = EmbeddingBatch()
+
+    if request.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+        buffer: bytes = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *line_list, buffer = buffer.split(b"\n")
+            for line in line_list:
+                await embedding_batch.add_raw(line)
+        await embedding_batch.add_raw(buffer)
+    else:
+        raw_data_list: Any = await request.json()
+        if not isinstance(raw_data_list, list):
+            raise HTTPException(status_code=422, detail="A list of embeddings is expected.")
+        for raw_data in raw_data_list:
+            await embedding_batch.add_raw(raw_data)
+
+    return await embedding_batch.flush()
 
 
 @app.get("/database", dependencies=[Depends(AuthenticateToken())])
 async def query(embedding_query: EmbeddingQuery) -> List[Embedding]:
-    return Embedding.query(embedding_query.input, embedding_query.index)
+    try:
+        return await Embedding.query(embedding_query)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.delete("/database", dependencies=[Depends(AuthenticateToken())])
+async def delete_embedding(embedding_delete: EmbeddingDelete) -> Dict[str, int]:
+    return {"deleted": await embedding_delete.delete()}
+
+
+@app.get("/database/search", dependencies=[Depends(AuthenticateToken())])
+async def search(embedding_query: EmbeddingQuery) -> EmbeddingSearchPage:
+    try:
+        return await Embedding.search(embedding_query)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.get("/database/index/{index}", dependencies=[Depends(AuthenticateToken())])
+async def get_vector_index_status(index: str) -> VectorIndexStatus:
+    return await VectorIndex.get_status(index)
+
+
+@app.post("/database/index/{index}", dependencies=[Depends(AuthenticateToken())])
+async def rebuild_vector_index(index: str) -> VectorIndexStatus:
+    return await VectorIndex.rebuild(index)
 
 
 @app.post("/embeddings", dependencies=[Depends(AuthenticateToken())])
 async def get_embeddings(request_body: Dict[str, Any] = Body(...)) -> Dict[str, Any]:
-    return await Embedding.get_raw_embedding(request_body["input"], request_body["model"])
+    return await Embedding.get_raw_embedding(request_body["input"], request_body["model"], bypass_cache=request_body.get("bypass_cache", False))
+
+
+@app.get("/metrics/database_pool", dependencies=[Depends(AuthenticateToken())])
+async def get_database_pool_statistics() -> Dict[str, int]:
+    return VectorStore.get_pool_statistics()
+
+
+@app.get("/metrics/embedding_cache", dependencies=[Depends(AuthenticateToken())])
+async def get_embedding_cache_statistics() -> Dict[str, int]:
+    return EmbeddingCache.get_statistics()
+
+
+@app.get("/metrics/http_client", dependencies=[Depends(AuthenticateToken())])
+async def get_http_client_statistics() -> Dict[str, int]:
+    return common.HTTPClient.get_statistics()
 
 
 if __name__ == "__main__":
@@ -1,18 +1,22 @@
+import base64
+import json
 import os
-from typing import Optional, List, Any, Dict
+from enum import Enum
+from typing import Optional, List, Any, Dict, Tuple
 
-import httpx
 from langchain_core.documents import Document
-from langchain_openai import OpenAIEmbeddings
 from langchain_postgres import PGVector
-from pydantic import BaseModel, Field
-from sqlalchemy import make_url, create_engine, Engine, URL, text
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy import make_url, create_engine, Engine, URL, text, Result
 
 import common
+from embedding_cache import EmbeddingCache
+from vector_index import VectorIndex
+from vector_store import VectorStore, DEFAULT_MODEL, BASE_URL, API_KEY
 
-DEFAULT_MODEL: str = os.getenv("VECTOR_EMBEDDING_SERVICE_DEFAULT_MODEL") or "text-embedding-3-small"
-BASE_URL: str = os.getenv("VECTOR_EMBEDDING_BASE_URL") or os.getenv("OPENAI_COMPATIBLE_API_BASE_URL") or "https://api.openai.com/v1"
-API_KEY: str = os.getenv("VECTOR_EMBEDDING_API_KEY") or os.getenv("OPENAI_COMPATIBLE_API_KEY") or os.getenv("OPENAI_API_KEY")
+BATCH_MAX_TOKENS: int = int(os.getenv("VECTOR_EMBEDDING_SERVICE_BATCH_MAX_TOKENS") or 100000)
+BATCH_MAX_SIZE: int = int(os.getenv("VECTOR_EMBEDDING_SERVICE_BATCH_MAX_SIZE") or 500)
+HYBRID_CANDIDATE_LIMIT: int = int(os.getenv("VECTOR_EMBEDDING_SERVICE_HYBRID_CANDIDATE_LIMIT") or 100)
 
 
 def initialize_database() -> None:
@@ -27,79 +31,381 @@ def initialize_database() -> None:
             conn.execute(text(f"CREATE DATABASE \"{database_name}\""))
 
 
+class UpsertStatus(str, Enum):
+    NEW = "new"
+    UPDATED = "updated"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+
+class EmbeddingUpsertResult(BaseModel):
+    id: Optional[str] = None
+    source: Optional[str] = None
+    status: UpsertStatus
+    detail: Optional[str] = None
+
+
 class Embedding(BaseModel):
     id: Optional[str] = None
     source: str
     content: str
     index: str
     embedding_model: Optional[str] = Field(default=DEFAULT_MODEL)
+    metadata: Dict[str, Any] = Field(default_factory=dict)
 
-    def upsert(self) -> None:
+    def _get_document(self) -> Document:
         if self.id is None:
             self.id = common.get_sha256_hash(self.source)
 
-        document: Document = Document(
+        return Document(
+            id=self.id,
             page_content=self.content,
-            metadata=self.model_dump(exclude={"content"}),
+            metadata=self.metadata | self.model_dump(exclude={"content", "metadata"}) | {"content_hash": common.get_sha256_hash(self.content)},
         )
 
-        vector_store = PGVector(
-            embeddings=OpenAIEmbeddings(model=self.embedding_model, base_url=BASE_URL, api_key=API_KEY),
-            collection_name=self.index,
-            connection=os.getenv("VECTOR_EMBEDDING_SERVICE_DATABASE_URL"),
-            use_jsonb=True,
-        )
+    async def upsert(self) -> EmbeddingUpsertResult:
+        embedding_batch: EmbeddingBatch = EmbeddingBatch()
+        await embedding_batch.add(self)
+        return (await embedding_batch.flush())[0]
+
+    @staticmethod
+    async def query(embedding_query: "EmbeddingQuery", model: Optional[str] = None) -> List["Embedding"]:
+        model = DEFAULT_MODEL if model is None else model
+        embedding_search_page: EmbeddingSearchPage = await Embedding.search(embedding_query.model_copy(update={"include_content": True}), model)
 
-        #   TODO: Figure out why "Failed to create vector extension: greenlet_spawn has not been called; can't call await_only() here. Was IO attempted in an unexpected place?" and make this asynchronous
-        # await asyncio.to_thread(vector_store.add_documents, [document], ids=[document.metadata["id"]])
-        vector_store.add_documents([document], ids=[document.metadata["id"]])
+        return [Embedding(
+            id=result.id,
+            source=result.source,
+            content=result.content,
+            index=result.index,
+            embedding_model=model
+        ) for result in embedding_search_page.results]
 
     @staticmethod
-    def query(query: str, index: str, model: Optional[str] = None, k: int = 10) -> List["Embedding"]:
+    async def search(embedding_query: "EmbeddingQuery", model: Optional[str] = None) -> "EmbeddingSearchPage":
         model = DEFAULT_MODEL if model is None else model
-        vector_store = PGVector(
-            embeddings=OpenAIEmbeddings(model=model),
-            collection_name=index,
-            connection=os.getenv("VECTOR_EMBEDDING_SERVICE_DATABASE_URL"),
-            use_jsonb=True,
+        offset: int = _decode_cursor(embedding_query.cursor)
+        index_list: List[str] = embedding_query.get_index_list()
+        if len(index_list) == 0:
+            raise ValueError("At least one index must be given")
+        if embedding_query.search_mode == SearchMode.HYBRID and embedding_query.vector_weight == 0 and embedding_query.lexical_weight == 0:
+            raise ValueError("At least one of vector_weight and lexical_weight must be positive")
+        if embedding_query.search_mode == SearchMode.HYBRID and embedding_query.score_threshold is not None:
+            raise ValueError("score_threshold is only supported by the vector search mode, hybrid scores are reciprocal rank fusion values")
+
+        collection_id_list: List[str] = [await VectorStore.get_collection_id(index, model) for index in index_list]
+        query_embedding: List[float] = await Embedding.get_query_embedding(embedding_query.input, model, embedding_query.bypass_cache)
+
+        dimensions: int = len(query_embedding)
+        for collection_id in collection_id_list:
+            VectorIndex.ensure(collection_id, dimensions)
+
+        #   Filters are pushed down into the SQL query so that only the requested page leaves the database
+        filter_list: List[str] = []
+        parameter_dict: Dict[str, Any] = {
+            "embedding": str(query_embedding),
+            "limit": embedding_query.top_k + 1,
+            "offset": offset,
+        } | {f"index_{i}": index for i, index in enumerate(index_list)}
+        if embedding_query.source_prefix is not None:
+            filter_list.append("starts_with(cmetadata->>'source', :source_prefix)")
+            parameter_dict["source_prefix"] = embedding_query.source_prefix
+        if embedding_query.metadata_filter is not None:
+            filter_list.append("cmetadata @> CAST(:metadata_filter AS jsonb)")
+            parameter_dict["metadata_filter"] = json.dumps(embedding_query.metadata_filter)
+
+        #   Every collection is searched by its own branch, so that each one can use its partial vector index, and the branches are ranked together
+        distance: str = f"{VectorIndex.get_expression(dimensions)} <=> CAST(:embedding AS vector({dimensions}))"
+        content: str = "document" if embedding_query.include_content else "NULL"
+        #   The fusion of a hybrid search only needs the ids, the rows of the final page are read once ranked
+        result_column_list: str = "" if embedding_query.search_mode == SearchMode.HYBRID else f", cmetadata->>'source' AS source, {content} AS content"
+        vector_branch_list: List[str] = [f"""
+                    (SELECT id, CAST(:index_{i} AS text) AS index_name{result_column_list}, {distance} AS distance
+                    FROM langchain_pg_embedding
+                    WHERE {" AND ".join([VectorIndex.get_predicate(collection_id, dimensions)] + filter_list)}
+                    ORDER BY {distance}
+                    LIMIT :candidate_limit)""" for i, collection_id in enumerate(collection_id_list)]
+        if embedding_query.search_mode == SearchMode.VECTOR:
+            parameter_dict["candidate_limit"] = offset + embedding_query.top_k + 1
+            statement: str = f"""
+                SELECT id, index_name, source, content, 1 - distance AS score
+                FROM ({" UNION ALL ".join(vector_branch_list)}
+                ) AS candidate
+                ORDER BY distance, id
+                LIMIT :limit OFFSET :offset
+            """
+        else:
+            lexical_expression: str = VectorIndex.get_lexical_expression()
+            lexical_branch_list: List[str] = []
+            for i, collection_id in enumerate(collection_id_list):
+                VectorIndex.ensure_lexical(collection_id)
+                lexical_branch_list.append(f"""
+                    (SELECT id, CAST(:index_{i} AS text) AS index_name, ts_rank_cd({lexical_expression}, lexical_query.query) AS lexical_score
+                    FROM langchain_pg_embedding, lexical_query
+                    WHERE {" AND ".join([VectorIndex.get_lexical_predicate(collection_id), f"{lexical_expression} @@ lexical_query.query"] + filter_list)}
+                    ORDER BY lexical_score DESC
+                    LIMIT :candidate_limit)""")
+
+            parameter_dict |= {
+                "input": embedding_query.input,
+                "candidate_limit": max(HYBRID_CANDIDATE_LIMIT, offset + embedding_query.top_k + 1),
+                "vector_weight": embedding_query.vector_weight,
+                "lexical_weight": embedding_query.lexical_weight,
+                "rrf_k": embedding_query.rrf_k,
+            }
+            #   Both rankings are computed and fused with weighted reciprocal rank fusion in a single round trip
+            #   The terms are OR-ed, so that a single matching identifier is enough for a document to be ranked
+            statement = f"""
+                WITH vector_search AS (
+                    SELECT id, index_name, row_number() OVER (ORDER BY distance) AS rank
+                    FROM ({" UNION ALL ".join(vector_branch_list)}
+                    ) AS candidate
+                ),
+                lexical_query AS (
+                    SELECT CAST(replace(CAST(plainto_tsquery('simple', :input) AS text), ' & ', ' | ') AS tsquery) AS query
+                ),
+                lexical_search AS (
+                    SELECT id, index_name, row_number() OVER (ORDER BY lexical_score DESC) AS rank
+                    FROM ({" UNION ALL ".join(lexical_branch_list)}
+                    ) AS candidate
+                ),
+                fusion AS (
+                    SELECT id, index_name, sum(weight / (:rrf_k + rank)) AS score
+                    FROM (
+                        SELECT id, index_name, rank, CAST(:vector_weight AS double precision) AS weight FROM vector_search
+                        UNION ALL
+                        SELECT id, index_name, rank, CAST(:lexical_weight AS double precision) AS weight FROM lexical_search
+                    ) AS ranking
+                    GROUP BY id, index_name
+                )
+                SELECT fusion.id, fusion.index_name, cmetadata->>'source' AS source, {content} AS content, fusion.score
+                FROM fusion
+                JOIN langchain_pg_embedding ON langchain_pg_embedding.id = fusion.id
+                ORDER BY fusion.score DESC, fusion.id
+                LIMIT :limit OFFSET :offset
+            """
+        async with VectorStore.get_engine().begin() as connection:
+            await VectorIndex.set_query_parameters(connection, embedding_query.ef_search, embedding_query.probes)
+            result: Result = await connection.execute(text(statement), parameter_dict)
+            row_list: List[Any] = list(result.all())
+
+        #   Rows are ordered by score, so the threshold is applied here rather than as a filter the index scan cannot use
+        has_next_page: bool = len(row_list) > embedding_query.top_k
+        if embedding_query.score_threshold is not None:
+            passing_row_list: List[Any] = [row for row in row_list if row.score >= embedding_query.score_threshold]
+            has_next_page = has_next_page and len(passing_row_list) == len(row_list)
+            row_list = passing_row_list
+
+        return EmbeddingSearchPage(
+            results=[EmbeddingSearchResult(id=row.id, source=row.source, index=row.index_name, score=row.score, content=row.content) for row in row_list[:embedding_query.top_k]],
+            next_cursor=_encode_cursor(offset + embedding_query.top_k) if has_next_page else None,
         )
 
-        #   TODO: Figure out why "Failed to create vector extension: greenlet_spawn has not been called; can't call await_only() here. Was IO attempted in an unexpected place?" and make this asynchronous
-        # document_list: List[Document] = await asyncio.to_thread(vector_store.similarity_search, query, k=k)
-        document_list: List[Document] = vector_store.similarity_search(query, k=k)
+    @staticmethod
+    async def get_query_embedding(query: str, model: str, bypass_cache: bool = False) -> List[float]:
+        if bypass_cache:
+            EmbeddingCache.add_bypass()
+            return await VectorStore.get_embeddings(model).aembed_query(query)
 
-        return [Embedding(
-            id=document.id,
-            source=document.metadata.get("source"),
-            content=document.page_content,
-            index=index,
-            embedding_model=model
-        ) for document in document_list]
+        query_embedding: Optional[List[float]] = await EmbeddingCache.get(query, model)
+        if query_embedding is None:
+            query_embedding = await VectorStore.get_embeddings(model).aembed_query(query)
+            await EmbeddingCache.set(query, model, query_embedding)
+
+        return query_embedding
 
     @staticmethod
-    async def get_raw_embedding(content: str, model: Optional[str] = None) -> Dict[str, Any]:
+    async def get_raw_embedding(content: str | List[str], model: Optional[str] = None, bypass_cache: bool = False) -> Dict[str, Any]:
         model = DEFAULT_MODEL if model is None else model
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BASE_URL}/embeddings",
-                json={"input": content, "model": model},
-                headers={"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"}
-            )
+        #   Only single texts are cached, lists of inputs are passed through as is
+        cacheable_content: Optional[str] = content if isinstance(content, str) and not bypass_cache else None
+        if bypass_cache:
+            EmbeddingCache.add_bypass()
+        elif cacheable_content is not None:
+            cached_embedding: Optional[List[float]] = await EmbeddingCache.get(cacheable_content, model)
+            if cached_embedding is not None:
+                return {
+                    "object": "list",
+                    "data": [{"object": "embedding", "index": 0, "embedding": cached_embedding}],
+                    "model": model,
+                    "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                }
 
+        headers: Dict[str, str] = {"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"}
+        async with common.HTTPClient.get_session().post(f"{BASE_URL}/embeddings", json={"input": content, "model": model}, headers=headers) as response:
             response.raise_for_status()  # Ensure the request was successful
-            return response.json()
+            raw_response: Dict[str, Any] = await response.json()
+
+        if cacheable_content is not None:
+            embedding: List[float] = raw_response["data"][0]["embedding"]
+            await EmbeddingCache.set(cacheable_content, model, embedding)
+
+        return raw_response
+
+
+class EmbeddingBatch:
+    def __init__(self) -> None:
+        self.result_list: List[Optional[EmbeddingUpsertResult]] = []
+        self._pending: Dict[Tuple[str, str], List[Tuple[int, Embedding]]] = {}
+        self._pending_tokens: Dict[Tuple[str, str], int] = {}
+
+    async def add(self, embedding: Embedding) -> None:
+        position: int = len(self.result_list)
+        self.result_list.append(None)
+
+        key: Tuple[str, str] = (embedding.index, embedding.embedding_model)
+        token_count: int = common.get_token_count(embedding.content, embedding.embedding_model)
+        pending_list: List[Tuple[int, Embedding]] = self._pending.setdefault(key, [])
+        if len(pending_list) > 0 and (self._pending_tokens[key] + token_count > BATCH_MAX_TOKENS or len(pending_list) >= BATCH_MAX_SIZE):
+            await self._flush(key)
+            pending_list = self._pending.setdefault(key, [])
+
+        pending_list.append((position, embedding))
+        self._pending_tokens[key] = self._pending_tokens.get(key, 0) + token_count
+
+    async def add_raw(self, raw_data: bytes | Dict[str, Any]) -> None:
+        if isinstance(raw_data, bytes) and raw_data.strip() == b"":
+            return
+
+        try:
+            embedding: Embedding = Embedding.model_validate_json(raw_data) if isinstance(raw_data, bytes) else Embedding.model_validate(raw_data)
+        except ValidationError as e:
+            self.result_list.append(EmbeddingUpsertResult(status=UpsertStatus.FAILED, detail=str(e)))
+            return
+
+        await self.add(embedding)
+
+    async def _flush(self, key: Tuple[str, str]) -> None:
+        pending_list: List[Tuple[int, Embedding]] = self._pending.pop(key, [])
+        self._pending_tokens.pop(key, None)
+        if len(pending_list) == 0:
+            return
+
+        document_dict: Dict[str, Document] = {}
+        for _, embedding in pending_list:
+            document: Document = embedding._get_document()
+            document_dict[document.id] = document
+
+        status_dict: Dict[str, UpsertStatus] = {}
+        detail: Optional[str] = None
+        try:
+            vector_store: PGVector = await VectorStore.get(*key)
+            existing_metadata_dict: Dict[str, Dict[str, Any]] = {document.id: document.metadata for document in await vector_store.aget_by_ids(list(document_dict.keys()))}
+
+            changed_document_list: List[Document] = []
+            for document_id, document in document_dict.items():
+                existing_metadata: Optional[Dict[str, Any]] = existing_metadata_dict.get(document_id)
+                if existing_metadata is None:
+                    status_dict[document_id] = UpsertStatus.NEW
+                elif existing_metadata != document.metadata:
+                    status_dict[document_id] = UpsertStatus.UPDATED
+                else:
+                    status_dict[document_id] = UpsertStatus.SKIPPED
+                    continue
+
+                changed_document_list.append(document)
+
+            if len(changed_document_list) > 0:
+                await vector_store.aadd_documents(changed_document_list, ids=[document.id for document in changed_document_list])
+                async with VectorStore.get_engine().begin() as connection:
+                    await VectorStore.increment_version(connection, key[0])
+        except Exception as e:
+            status_dict = {document_id: UpsertStatus.FAILED for document_id in document_dict.keys()}
+            detail = str(e)
+
+        for position, embedding in pending_list:
+            self.result_list[position] = EmbeddingUpsertResult(id=embedding.id, source=embedding.source, status=status_dict[embedding.id], detail=detail)
+
+    async def flush(self) -> List[EmbeddingUpsertResult]:
+        for key in list(self._pending.keys()):
+            await self._flush(key)
+
+        return [result for result in self.result_list if result is not None]
 
 
 class EmbeddingGet(BaseModel):
     input: str
     model: str = Field(default="text-embedding-3-small")
+    bypass_cache: bool = Field(default=False)
+
+
+class SearchMode(str, Enum):
+    VECTOR = "vector"
+    HYBRID = "hybrid"
 
 
 class EmbeddingQuery(BaseModel):
     input: str
+    index: Optional[str] = None
+    index_list: List[str] = Field(default_factory=list)
+    top_k: int = Field(default=10, gt=0)
+    #   Vector scores are cosine similarities from -1 to 1, hybrid scores are reciprocal rank fusion values of at most (vector_weight + lexical_weight) / (rrf_k + 1)
+    #   The threshold applies to vector scores only, a hybrid search with a threshold is rejected
+    score_threshold: Optional[float] = Field(default=None, ge=-1, le=1)
+    cursor: Optional[str] = None
+    source_prefix: Optional[str] = None
+    metadata_filter: Optional[Dict[str, Any]] = None
+    include_content: bool = Field(default=True)
+    ef_search: Optional[int] = Field(default=None, gt=0)
+    probes: Optional[int] = Field(default=None, gt=0)
+    bypass_cache: bool = Field(default=False)
+    search_mode: SearchMode = Field(default=SearchMode.VECTOR)
+    vector_weight: float = Field(default=1.0, ge=0)
+    lexical_weight: float = Field(default=1.0, ge=0)
+    rrf_k: int = Field(default=60, gt=0)
+
+    def get_index_list(self) -> List[str]:
+        return list(dict.fromkeys(([self.index] if self.index is not None else []) + self.index_list))
+
+
+class EmbeddingDelete(BaseModel):
     index: str
-    top_k: int = Field(default=10)
+    source: str
+    keep_id_list: List[str] = Field(default_factory=list)
+
+    async def delete(self) -> int:
+        collection_id: str = await VectorStore.get_collection_id(self.index)
+        async with VectorStore.get_engine().begin() as connection:
+            result: Result = await connection.execute(
+                text("DELETE FROM langchain_pg_embedding WHERE collection_id = CAST(:collection_id AS uuid) AND cmetadata->>'source' = :source AND NOT (id = ANY(:keep_id_list))"),
+                {"collection_id": collection_id, "source": self.source, "keep_id_list": self.keep_id_list}
+            )
+            if result.rowcount > 0:  # type: ignore[attr-defined]
+                await VectorStore.increment_version(connection, self.index)
+
+        return result.rowcount  # type: ignore[attr-defined]
+
+
+class EmbeddingSearchResult(BaseModel):
+    id: str
+    source: Optional[str] = None
+    index: str
+    score: float
+    content: Optional[str] = None
+
+
+class EmbeddingSearchPage(BaseModel):
+    results: List[EmbeddingSearchResult]
+    next_cursor: Optional[str] = None
+
+
+def _encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("utf-8")
+
+
+def _decode_cursor(cursor: Optional[str]) -> int:
+    if cursor is None:
+        return 0
+
+    try:
+        offset: Any = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))["offset"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor.")
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError("Invalid cursor.")
+
+    return offset
 
 
 initialize_database()
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import os
+from enum import Enum
+from logging import Logger
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+from sqlalchemy import text, Result
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from vector_store import VectorStore
+
+logger: Logger = logging.getLogger(__name__)
+
+
+class VectorIndexType(str, Enum):
+    HNSW = "hnsw"
+    IVFFLAT = "ivfflat"
+
+
+VECTOR_INDEX_TYPE: VectorIndexType = VectorIndexType(os.getenv("VECTOR_EMBEDDING_SERVICE_VECTOR_INDEX_TYPE") or VectorIndexType.HNSW)
+HNSW_M: int = int(os.getenv("VECTOR_EMBEDDING_SERVICE_HNSW_M") or 16)
+HNSW_EF_CONSTRUCTION: int = int(os.getenv("VECTOR_EMBEDDING_SERVICE_HNSW_EF_CONSTRUCTION") or 64)
+IVFFLAT_LISTS: int = int(os.getenv("VECTOR_EMBEDDING_SERVICE_IVFFLAT_LISTS") or 100)
+#   pgvector cannot index the vector type above 2000 dimensions
+VECTOR_INDEX_MAXIMUM_DIMENSIONS: int = 2000
+#   The lexical index shares the task bookkeeping of the vector indexes under a dimension no embedding can have
+LEXICAL_INDEX_DIMENSIONS: int = 0
+
+
+class VectorIndexInformation(BaseModel):
+    name: str
+    method: str
+    is_valid: bool
+    size: int
+    definition: str
+
+
+class VectorIndexStatus(BaseModel):
+    index: str
+    collection_id: str
+    row_count_dict: Dict[int, int]
+    index_list: List[VectorIndexInformation]
+    building_dimension_list: List[int]
+
+
+class VectorIndex:
+    _handled_set: Set[Tuple[str, int]] = set()
+    _task_dict: Dict[Tuple[str, int], asyncio.Task] = {}
+
+    @staticmethod
+    def get_name_prefix(collection_id: str) -> str:
+        return f"ix_embedding_{collection_id.replace('-', '')}_"
+
+    @staticmethod
+    def get_name(collection_id: str, dimensions: int) -> str:
+        return f"{VectorIndex.get_name_prefix(collection_id)}{dimensions}"
+
+    @staticmethod
+    def get_expression(dimensions: int) -> str:
+        #   The embedding column has no fixed dimensions, so both the index and the queries cast it to the same expression
+        return f"CAST(embedding AS vector({dimensions}))"
+
+    @staticmethod
+    def get_predicate(collection_id: str, dimensions: int) -> str:
+        #   Literals rather than parameters, so that the planner can match the partial index predicate
+        return f"collection_id = '{collection_id}' AND vector_dims(embedding) = {dimensions}"
+
+    @staticmethod
+    def get_lexical_name(collection_id: str) -> str:
+        return f"{VectorIndex.get_name_prefix(collection_id)}lexical"
+
+    @staticmethod
+    def get_lexical_expression() -> str:
+        #   The simple configuration does not stem, so identifiers such as Jira keys and file paths are matched as written
+        return "to_tsvector('simple', document)"
+
+    @staticmethod
+    def get_lexical_predicate(collection_id: str) -> str:
+        return f"collection_id = '{collection_id}'"
+
+    @staticmethod
+    def _get_option_dict() -> Dict[str, int]:
+        return {"lists": IVFFLAT_LISTS} if VECTOR_INDEX_TYPE == VectorIndexType.IVFFLAT else {"m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION}
+
+    @staticmethod
+    def _get_create_statement(collection_id: str, dimensions: int, name: Optional[str] = None) -> str:
+        option: str = ", ".join(f"{key} = {value}" for key, value in VectorIndex._get_option_dict().items())
+        return (f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name or VectorIndex.get_name(collection_id, dimensions)} ON langchain_pg_embedding "
+                f"USING {VECTOR_INDEX_TYPE.value} (({VectorIndex.get_expression(dimensions)}) vector_cosine_ops) WITH ({option}) "
+                f"WHERE {VectorIndex.get_predicate(collection_id, dimensions)}")
+
+    @staticmethod
+    async def _get_index_row(connection: AsyncConnection, name: str) -> Optional[Any]:
+        result: Result = await connection.execute(text("""
+            SELECT access_method.amname AS method, class.reloptions AS option_list
+            FROM pg_class class
+            JOIN pg_am access_method ON access_method.oid = class.relam
+            WHERE class.relname = :name
+        """), {"name": name})
+        return result.first()
+
+    @staticmethod
+    async def _rebuild(connection: AsyncConnection, collection_id: str, dimensions: int) -> bool:
+        name: str = VectorIndex.get_name(collection_id, dimensions)
+        index_row: Optional[Any] = await VectorIndex._get_index_row(connection, name)
+        if index_row is None:
+            return False
+
+        #   Unchanged parameters, the index is rebuilt in place and the old one serves searches until the new one replaces it
+        if index_row.method == VECTOR_INDEX_TYPE.value and set(index_row.option_list or []) == {f"{key}={value}" for key, value in VectorIndex._get_option_dict().items()}:
+            await connection.execute(text(f"REINDEX INDEX CONCURRENTLY {name}"))
+            return True
+
+        #   Changed parameters, the new index is built next to the old one, so that the collection is never left without an index
+        rebuild_name: str = f"{name}_rebuild"
+        await connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {rebuild_name}"))
+        await connection.execute(text(VectorIndex._get_create_statement(collection_id, dimensions, rebuild_name)))
+        await connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        await connection.execute(text(f"ALTER INDEX {rebuild_name} RENAME TO {name}"))
+        return True
+
+    @staticmethod
+    async def _create(collection_id: str, dimensions: int, is_rebuild: bool = False) -> bool:
+        async with VectorStore.get_engine().connect() as connection:
+            #   CONCURRENTLY keeps the table writable during the build but cannot run inside a transaction
+            connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+
+            if VECTOR_INDEX_TYPE == VectorIndexType.IVFFLAT and not is_rebuild:
+                #   IVFFlat centroids are computed at build time, so the build waits until there is enough data
+                result: Result = await connection.execute(text(f"SELECT count(*) FROM langchain_pg_embedding WHERE {VectorIndex.get_predicate(collection_id, dimensions)}"))
+                if result.scalar_one() < IVFFLAT_LISTS:
+                    return False
+
+            if is_rebuild and await VectorIndex._rebuild(connection, collection_id, dimensions):
+                return True
+            await connection.execute(text(VectorIndex._get_create_statement(collection_id, dimensions)))
+
+        return True
+
+    @staticmethod
+    async def _create_lexical(collection_id: str, is_rebuild: bool = False) -> bool:
+        async with VectorStore.get_engine().connect() as connection:
+            connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+            #   The lexical index has no parameters, so an existing one is always rebuilt in place
+            if is_rebuild and await VectorIndex._get_index_row(connection, VectorIndex.get_lexical_name(collection_id)) is not None:
+                await connection.execute(text(f"REINDEX INDEX CONCURRENTLY {VectorIndex.get_lexical_name(collection_id)}"))
+                return True
+            await connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {VectorIndex.get_lexical_name(collection_id)} ON langchain_pg_embedding "
+                                          f"USING gin (({VectorIndex.get_lexical_expression()})) WHERE {VectorIndex.get_lexical_predicate(collection_id)}"))
+
+        return True
+
+    @staticmethod
+    def _on_created(key: Tuple[str, int], task: asyncio.Task) -> None:
+        VectorIndex._task_dict.pop(key, None)
+        if task.cancelled():
+            return
+        name: str = VectorIndex.get_name(*key) if key[1] != LEXICAL_INDEX_DIMENSIONS else VectorIndex.get_lexical_name(key[0])
+        if task.exception() is not None:
+            logger.error(f"Vector index creation failed | {name} | {task.exception()}")
+        elif task.result():
+            logger.info(f"Vector index created | {name}")
+            VectorIndex._handled_set.add(key)
+
+    @staticmethod
+    def ensure(collection_id: str, dimensions: int) -> None:
+        key: Tuple[str, int] = (collection_id, dimensions)
+        if key in VectorIndex._handled_set or key in VectorIndex._task_dict:
+            return
+
+        if dimensions > VECTOR_INDEX_MAXIMUM_DIMENSIONS:
+            logger.warning(f"Vector index skipped as the embeddings have too many dimensions | {collection_id} | {dimensions}")
+            VectorIndex._handled_set.add(key)
+            return
+
+        task: asyncio.Task = asyncio.create_task(VectorIndex._create(collection_id, dimensions))
+        VectorIndex._task_dict[key] = task
+        task.add_done_callback(lambda done_task: VectorIndex._on_created(key, done_task))
+
+    @staticmethod
+    def ensure_lexical(collection_id: str) -> None:
+        key: Tuple[str, int] = (collection_id, LEXICAL_INDEX_DIMENSIONS)
+        if key in VectorIndex._handled_set or key in VectorIndex._task_dict:
+            return
+
+        task: asyncio.Task = asyncio.create_task(VectorIndex._create_lexical(collection_id))
+        VectorIndex._task_dict[key] = task
+        task.add_done_callback(lambda done_task: VectorIndex._on_created(key, done_task))
+
+    @staticmethod
+    async def get_status(index: str) -> VectorIndexStatus:
+        collection_id: str = await VectorStore.get_collection_id(index)
+        async with VectorStore.get_engine().connect() as connection:
+            row_count_result: Result = await connection.execute(text("SELECT vector_dims(embedding) AS dimensions, count(*) AS row_count FROM langchain_pg_embedding WHERE collection_id = CAST(:collection_id AS uuid) GROUP BY 1"), {"collection_id": collection_id})
+            row_count_dict: Dict[int, int] = {row.dimensions: row.row_count for row in row_count_result.all()}
+
+            index_result: Result = await connection.execute(text("""
+                SELECT class.relname AS name, access_method.amname AS method, pg_index.indisvalid AS is_valid, pg_relation_size(pg_index.indexrelid) AS size, pg_get_indexdef(pg_index.indexrelid) AS definition
+                FROM pg_index
+                JOIN pg_class class ON class.oid = pg_index.indexrelid
+                JOIN pg_am access_method ON access_method.oid = class.relam
+                WHERE starts_with(class.relname, :name_prefix)
+            """), {"name_prefix": VectorIndex.get_name_prefix(collection_id)})
+            index_list: List[VectorIndexInformation] = [VectorIndexInformation.model_validate(row._asdict()) for row in index_result.all()]
+
+        return VectorIndexStatus(
+            index=index,
+            collection_id=collection_id,
+            row_count_dict=row_count_dict,
+            index_list=index_list,
+            building_dimension_list=[dimensions for task_collection_id, dimensions in VectorIndex._task_dict.keys() if task_collection_id == collection_id and dimensions != LEXICAL_INDEX_DIMENSIONS],
+        )
+
+    @staticmethod
+    async def rebuild(index: str) -> VectorIndexStatus:
+        vector_index_status: VectorIndexStatus = await VectorIndex.get_status(index)
+        for dimensions in vector_index_status.row_count_dict.keys():
+            if dimensions > VECTOR_INDEX_MAXIMUM_DIMENSIONS:
+                continue
+
+            running_task: Optional[asyncio.Task] = VectorIndex._task_dict.get((vector_index_status.collection_id, dimensions))
+            if running_task is not None:
+                await asyncio.wait([running_task])
+            await VectorIndex._create(vector_index_status.collection_id, dimensions, is_rebuild=True)
+            VectorIndex._handled_set.add((vector_index_status.collection_id, dimensions))
+
+        #   The lexical index is only rebuilt once a hybrid search created it
+        if any(information.name == VectorIndex.get_lexical_name(vector_index_status.collection_id) for information in vector_index_status.index_list):
+            running_task = VectorIndex._task_dict.get((vector_index_status.collection_id, LEXICAL_INDEX_DIMENSIONS))
+            if running_task is not None:
+                await asyncio.wait([running_task])
+            await VectorIndex._create_lexical(vector_index_status.collection_id, is_rebuild=True)
+            VectorIndex._handled_set.add((vector_index_status.collection_id, LEXICAL_INDEX_DIMENSIONS))
+
+        return await VectorIndex.get_status(index)
+
+    @staticmethod
+    async def set_query_parameters(connection: AsyncConnection, ef_search: Optional[int], probes: Optional[int]) -> None:
+        #   Equivalent to SET LOCAL, the values only last until the end of the transaction
+        if ef_search is not None:
+            await connection.execute(text("SELECT set_config('hnsw.ef_search', :value, true)"), {"value": str(ef_search)})
+        if probes is not None:
+            await connection.execute(text("SELECT set_config('ivfflat.probes', :value, true)"), {"value": str(probes)})
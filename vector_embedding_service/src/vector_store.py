@@ -0,0 +1,103 @@
+import asyncio
+import os
+from typing import Dict, Tuple, Optional
+
+from langchain_openai import OpenAIEmbeddings
+from langchain_postgres import PGVector
+from sqlalchemy import make_url, URL, AsyncAdaptedQueuePool, Result, text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncConnection
+
+DEFAULT_MODEL: str = os.getenv("VECTOR_EMBEDDING_SERVICE_DEFAULT_MODEL") or "text-embedding-3-small"
+BASE_URL: str = os.getenv("VECTOR_EMBEDDING_BASE_URL") or os.getenv("OPENAI_COMPATIBLE_API_BASE_URL") or "https://api.openai.com/v1"
+API_KEY: str = os.getenv("VECTOR_EMBEDDING_API_KEY") or os.getenv("OPENAI_COMPATIBLE_API_KEY") or os.getenv("OPENAI_API_KEY")
+POOL_SIZE: int = int(os.getenv("DATABASE_POOL_SIZE") or 5)
+POOL_MAX_OVERFLOW: int = int(os.getenv("DATABASE_POOL_MAX_OVERFLOW") or 10)
+
+
+class VectorStore:
+    _engine: Optional[AsyncEngine] = None
+    _embeddings_dict: Dict[str, OpenAIEmbeddings] = {}
+    _vector_store_dict: Dict[Tuple[str, str], PGVector] = {}
+    _collection_id_dict: Dict[str, str] = {}
+    _lock: asyncio.Lock = asyncio.Lock()
+
+    @staticmethod
+    def get_engine() -> AsyncEngine:
+        if VectorStore._engine is None:
+            #   psycopg (v3) is used as asyncpg cannot run the multi-statement vector extension check in langchain_postgres
+            url: URL = make_url(os.getenv("VECTOR_EMBEDDING_SERVICE_DATABASE_URL")).set(drivername="postgresql+psycopg")
+            VectorStore._engine = create_async_engine(
+                url,
+                pool_size=POOL_SIZE,
+                max_overflow=POOL_MAX_OVERFLOW,
+                pool_pre_ping=True,
+            )
+
+        return VectorStore._engine
+
+    @staticmethod
+    def get_embeddings(model: Optional[str] = None) -> OpenAIEmbeddings:
+        model = DEFAULT_MODEL if model is None else model
+        if model not in VectorStore._embeddings_dict:
+            VectorStore._embeddings_dict[model] = OpenAIEmbeddings(model=model, base_url=BASE_URL, api_key=API_KEY)
+
+        return VectorStore._embeddings_dict[model]
+
+    @staticmethod
+    async def get(index: str, model: Optional[str] = None) -> PGVector:
+        model = DEFAULT_MODEL if model is None else model
+        key: Tuple[str, str] = (index, model)
+        if key in VectorStore._vector_store_dict:
+            return VectorStore._vector_store_dict[key]
+
+        async with VectorStore._lock:
+            if key not in VectorStore._vector_store_dict:
+                vector_store: PGVector = PGVector(
+                    embeddings=VectorStore.get_embeddings(model),
+                    collection_name=index,
+                    connection=VectorStore.get_engine(),
+                    use_jsonb=True,
+                )
+                await vector_store.acreate_collection()
+                VectorStore._vector_store_dict[key] = vector_store
+
+        return VectorStore._vector_store_dict[key]
+
+    @staticmethod
+    async def get_collection_id(index: str, model: Optional[str] = None) -> str:
+        if index not in VectorStore._collection_id_dict:
+            await VectorStore.get(index, model)
+            async with VectorStore.get_engine().connect() as connection:
+                result: Result = await connection.execute(text("SELECT uuid FROM langchain_pg_collection WHERE name = :name"), {"name": index})
+                VectorStore._collection_id_dict[index] = str(result.scalar_one())
+
+        return VectorStore._collection_id_dict[index]
+
+    @staticmethod
+    async def increment_version(connection: AsyncConnection, index: str) -> None:
+        #   Consumers such as the semantic cache of the sergeant service compare this version to detect that an index changed
+        await connection.execute(
+            text("UPDATE langchain_pg_collection "
+                 "SET cmetadata = CAST((CASE WHEN json_typeof(cmetadata) = 'object' THEN CAST(cmetadata AS jsonb) ELSE CAST('{}' AS jsonb) END) || jsonb_build_object('version', COALESCE(CAST(cmetadata->>'version' AS bigint), 0) + 1) AS json) "
+                 "WHERE name = :name"),
+            {"name": index}
+        )
+
+    @staticmethod
+    def get_pool_statistics() -> Dict[str, int]:
+        pool: AsyncAdaptedQueuePool = VectorStore.get_engine().pool  # type: ignore[assignment]
+        return {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "vector_store_count": len(VectorStore._vector_store_dict),
+        }
+
+    @staticmethod
+    async def close() -> None:
+        if VectorStore._engine is not None:
+            await VectorStore._engine.dispose()
+            VectorStore._engine = None
+            VectorStore._vector_store_dict.clear()
+            VectorStore._collection_id_dict.clear()
@@ -1,11 +1,19 @@
+import asyncio
+import base64
+import json
+import statistics
+import time
+import uuid
 from typing import Dict, Any, List
 
 import aiohttp
 import pytest
 
-from src.models import Embedding, EmbeddingGet, EmbeddingQuery
+from src import common
+from src.models import Embedding, EmbeddingGet, EmbeddingQuery, SearchMode
 
 BASE_URL: str ="http://0.0.0.0:8001"
+MAXIMUM_P99_LATENCY_DEGRADATION: float = 3.0
 
 
 @pytest.mark.asyncio
@@ -17,6 +25,26 @@ async def test_get_embeddings() -> None:
         async with session.post(url, json=json) as response:
             assert response.status == 200
 
+@pytest.mark.asyncio
+async def test_get_embeddings_cached() -> None:
+    json: Dict[Any, Any] = EmbeddingGet(input="The capital of Italy is Rome.", model="text-embedding-3-small").model_dump()
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{BASE_URL}/embeddings", json=json) as response:
+            assert response.status == 200
+            embedding: List[float] = (await response.json())["data"][0]["embedding"]
+
+        async with session.get(f"{BASE_URL}/metrics/embedding_cache") as response:
+            memory_hit_count: int = (await response.json())["memory_hit_count"]
+
+        json["input"] = "  The capital of Italy   is Rome. "
+        async with session.post(f"{BASE_URL}/embeddings", json=json) as response:
+            assert response.status == 200
+            assert (await response.json())["data"][0]["embedding"] == embedding
+
+        async with session.get(f"{BASE_URL}/metrics/embedding_cache") as response:
+            assert (await response.json())["memory_hit_count"] == memory_hit_count + 1
+
 @pytest.mark.asyncio
 async def test_upsert_embeddings() -> None:
     url: str = f"{BASE_URL}/database"
@@ -32,6 +60,45 @@ async def test_upsert_embeddings() -> None:
         async with session.post(url, json=embedding.model_dump()) as response:
             assert response.status == 200
 
+@pytest.mark.asyncio
+async def test_upsert_unchanged_embeddings_are_skipped() -> None:
+    url: str = f"{BASE_URL}/database"
+    embedding: Embedding = Embedding(
+        source="Testing Unchanged",
+        content="The capital of Italy is Rome.",
+        index="TEST",
+        embedding_model="text-embedding-3-small"
+    )
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=embedding.model_dump()) as response:
+            assert response.status == 200
+
+        async with session.post(url, json=embedding.model_dump()) as response:
+            return_data: Dict[str, Any] = await response.json()
+            assert return_data["status"] == "skipped"
+
+@pytest.mark.asyncio
+async def test_delete_stale_chunks() -> None:
+    embedding_list: List[Dict[str, Any]] = [Embedding(
+        id=f"Testing Chunks#{i}",
+        source="Testing Chunks",
+        content=f"Chunk number {i} of the document.",
+        index="TEST",
+        metadata={"chunk_index": i, "chunk_offset": i * 100}
+    ).model_dump() for i in range(3)]
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{BASE_URL}/database/batch", json=embedding_list) as response:
+            assert response.status == 200
+
+        async with session.delete(f"{BASE_URL}/database", json={"index": "TEST", "source": "Testing Chunks", "keep_id_list": ["Testing Chunks#0"]}) as response:
+            assert response.status == 200
+            assert (await response.json())["deleted"] == 2
+
+        async with session.get(f"{BASE_URL}/database/search", json=EmbeddingQuery(input="Chunk number", index="TEST", metadata_filter={"source": "Testing Chunks"}).model_dump()) as response:
+            assert [result["id"] for result in (await response.json())["results"]] == ["Testing Chunks#0"]
+
 @pytest.mark.asyncio
 async def test_query_embeddings() -> None:
     url: str = f"{BASE_URL}/database"
@@ -41,3 +108,196 @@ async def test_query_embeddings() -> None:
         async with session.get(url, json=EmbeddingQuery(input=text, index="TEST").model_dump()) as response:
             return_data: Dict[str, Any] = await response.json()
             assert len(return_data) > 0
+
+
+@pytest.mark.asyncio
+async def test_search_embeddings_paginated() -> None:
+    url: str = f"{BASE_URL}/database/search"
+    embedding_list: List[Dict[str, Any]] = [
+        Embedding(source=f"SearchTesting/{i}", content=f"Search test document number {i}.", index="TEST").model_dump() for i in range(3)
+    ]
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{BASE_URL}/database/batch", json=embedding_list) as response:
+            assert response.status == 200
+
+        embedding_query: EmbeddingQuery = EmbeddingQuery(input="Search test document", index="TEST", top_k=2, source_prefix="SearchTesting/", include_content=False)
+        async with session.get(url, json=embedding_query.model_dump()) as response:
+            assert response.status == 200
+            first_page: Dict[str, Any] = await response.json()
+            assert len(first_page["results"]) == 2
+            assert all(result["content"] is None for result in first_page["results"])
+            assert first_page["next_cursor"] is not None
+
+        embedding_query.cursor = first_page["next_cursor"]
+        async with session.get(url, json=embedding_query.model_dump()) as response:
+            second_page: Dict[str, Any] = await response.json()
+            assert [result["source"] for result in second_page["results"]] == [f"SearchTesting/{i}" for i in range(3) if f"SearchTesting/{i}" not in [result["source"] for result in first_page["results"]]]
+            assert second_page["next_cursor"] is None
+
+        embedding_query.cursor = "invalid"
+        async with session.get(url, json=embedding_query.model_dump()) as response:
+            assert response.status == 422
+
+
+@pytest.mark.asyncio
+async def test_search_embeddings_hybrid() -> None:
+    url: str = f"{BASE_URL}/database/search"
+    embedding_list: List[Dict[str, Any]] = [
+        Embedding(source="HybridTesting/LT-4821", content="The upload fails with error code LT-4821 when the archive is empty.", index="TEST").model_dump(),
+        Embedding(source="HybridTesting/Other", content="Uploads of empty archives are rejected by the intelligence service.", index="TEST").model_dump(),
+    ]
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{BASE_URL}/database/batch", json=embedding_list) as response:
+            assert response.status == 200
+
+        embedding_query: EmbeddingQuery = EmbeddingQuery(input="LT-4821", index="TEST", top_k=2, source_prefix="HybridTesting/", search_mode=SearchMode.HYBRID, vector_weight=0.5)
+        async with session.get(url, json=embedding_query.model_dump()) as response:
+            assert response.status == 200
+            assert (await response.json())["results"][0]["source"] == "HybridTesting/LT-4821"
+
+        embedding_query.score_threshold = 0.5
+        async with session.get(url, json=embedding_query.model_dump()) as response:
+            assert response.status == 422
+
+        embedding_query.score_threshold = None
+        embedding_query.vector_weight, embedding_query.lexical_weight = 0, 0
+        async with session.get(url, json=embedding_query.model_dump()) as response:
+            assert response.status == 422
+
+
+@pytest.mark.asyncio
+async def test_search_embeddings_across_indexes() -> None:
+    url: str = f"{BASE_URL}/database/search"
+    embedding_list: List[Dict[str, Any]] = [
+        Embedding(source="CrossIndexTesting/Paris", content="Paris is the capital of France.", index="TEST").model_dump(),
+        Embedding(source="CrossIndexTesting/Berlin", content="Berlin is the capital of Germany.", index="TEST_SECONDARY").model_dump(),
+    ]
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{BASE_URL}/database/batch", json=embedding_list) as response:
+            assert response.status == 200
+
+        embedding_query: EmbeddingQuery = EmbeddingQuery(input="What is the capital of Germany?", index_list=["TEST", "TEST_SECONDARY"], top_k=2, source_prefix="CrossIndexTesting/")
+        async with session.get(url, json=embedding_query.model_dump()) as response:
+            assert response.status == 200
+            result_list: List[Dict[str, Any]] = (await response.json())["results"]
+            assert [(result["source"], result["index"]) for result in result_list] == [("CrossIndexTesting/Berlin", "TEST_SECONDARY"), ("CrossIndexTesting/Paris", "TEST")]
+
+        async with session.get(url, json=EmbeddingQuery(input="What is the capital of Germany?").model_dump()) as response:
+            assert response.status == 422
+
+
+@pytest.mark.asyncio
+async def test_rebuild_vector_index() -> None:
+    url: str = f"{BASE_URL}/database/index/TEST"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{BASE_URL}/database/search", json=EmbeddingQuery(input="What is the capital of France?", index="TEST", ef_search=100).model_dump()) as response:
+            assert response.status == 200
+
+        async with session.post(url) as response:
+            assert response.status == 200
+
+        async with session.get(url) as response:
+            assert response.status == 200
+            return_data: Dict[str, Any] = await response.json()
+            assert len(return_data["index_list"]) > 0
+            assert all(index["is_valid"] for index in return_data["index_list"])
+
+
+@pytest.mark.asyncio
+async def test_upsert_embeddings_batch() -> None:
+    url: str = f"{BASE_URL}/database/batch"
+    embedding_list: List[Dict[str, Any]] = [Embedding(
+        source=f"Testing {i}",
+        content=f"The number {i} comes after {i - 1}.",
+        index="TEST",
+        embedding_model="text-embedding-3-small"
+    ).model_dump() for i in range(10)]
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=embedding_list) as response:
+            return_data: List[Dict[str, Any]] = await response.json()
+            assert response.status == 200
+            assert len(return_data) == len(embedding_list)
+            assert all(result["status"] != "failed" for result in return_data)
+
+
+@pytest.mark.asyncio
+async def test_upsert_embeddings_batch_ndjson() -> None:
+    url: str = f"{BASE_URL}/database/batch"
+    ndjson: str = "\n".join(Embedding(source=f"Testing NDJSON {i}", content=f"The letter {chr(65 + i)} is letter number {i + 1}.", index="TEST").model_dump_json() for i in range(5))
+    ndjson = ndjson + "\n{\"source\": \"Invalid\"}\n"
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=ndjson, headers={"Content-Type": "application/x-ndjson"}) as response:
+            return_data: List[Dict[str, Any]] = await response.json()
+            assert response.status == 200
+            assert len(return_data) == 6
+            assert return_data[-1]["status"] == "failed"
+
+
+async def _get_query_latency_list(session: aiohttp.ClientSession, count: int) -> List[float]:
+    url: str = f"{BASE_URL}/database"
+    latency_list: List[float] = []
+    for _ in range(count):
+        start_time: float = time.perf_counter()
+        async with session.get(url, json=EmbeddingQuery(input="What is the capital of France?", index="TEST").model_dump()) as response:
+            assert response.status == 200
+            await response.read()
+        latency_list.append(time.perf_counter() - start_time)
+
+    return latency_list
+
+
+@pytest.mark.asyncio
+async def test_query_latency_under_parallel_upserts() -> None:
+    url: str = f"{BASE_URL}/database/batch"
+    embedding_list: List[Dict[str, Any]] = [Embedding(source=f"Benchmark {i}", content=f"Benchmark document number {i}. " * 50, index="TEST_BENCHMARK").model_dump() for i in range(50)]
+
+    async with aiohttp.ClientSession() as session:
+        baseline_latency_list: List[float] = await _get_query_latency_list(session, 50)
+
+        async def upsert() -> None:
+            async with session.post(url, json=embedding_list) as response:
+                assert response.status == 200
+
+        upsert_task = asyncio.gather(*[upsert() for _ in range(8)])
+        loaded_latency_list: List[float] = await _get_query_latency_list(session, 50)
+        await upsert_task
+
+    baseline_p99: float = statistics.quantiles(baseline_latency_list, n=100)[98]
+    loaded_p99: float = statistics.quantiles(loaded_latency_list, n=100)[98]
+    print(f"Query p99 latency | Baseline: {baseline_p99 * 1000:.1f} ms | Under parallel upserts: {loaded_p99 * 1000:.1f} ms")
+    assert loaded_p99 < baseline_p99 * MAXIMUM_P99_LATENCY_DEGRADATION
+
+
+def _get_jwt_segment(data: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).rstrip(b"=").decode("utf-8")
+
+
+@pytest.mark.asyncio
+async def test_is_valid_jwt_token_rejects_malformed_and_expired_tokens(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(common, "JWT_SECRET", None)
+    header_segment: str = _get_jwt_segment({"alg": "HS256", "typ": "JWT"})
+
+    assert not await common.is_valid_jwt_token("a.MQ.b")
+    assert not await common.is_valid_jwt_token("a.eyJleHAiOiJ4In0.b")
+    assert not await common.is_valid_jwt_token(f"{header_segment}.{_get_jwt_segment({'exp': time.time() - 60})}.b")
+
+    monkeypatch.setattr(common, "JWT_SECRET", "secret")
+    assert not await common.is_valid_jwt_token(f"MQ.{_get_jwt_segment({'exp': time.time() + 60})}.b")
+
+
+@pytest.mark.asyncio
+async def test_is_valid_jwt_token_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(common, "JWT_SECRET", None)
+    jwt_token_list: List[str] = [f"cached-token-{uuid.uuid4()}", f"cached-token-{uuid.uuid4()}"]
+    for jwt_token in jwt_token_list:
+        common._jwt_validation_cache[common.get_sha256_hash(jwt_token)] = (True, time.time() + 60)
+
+    #   A cached token is answered without Open WebUI and becomes the most recently used entry
+    assert await common.is_valid_jwt_token(jwt_token_list[0])
+    assert next(reversed(common._jwt_validation_cache)) == common.get_sha256_hash(jwt_token_list[0])